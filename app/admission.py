@@ -0,0 +1,135 @@
+import os
+import threading
+from typing import Iterator, TypeVar
+
+from fastapi import HTTPException
+from sqlalchemy.exc import DBAPIError
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse
+
+from . import database, metrics
+
+T = TypeVar("T")
+
+# Largest `limit` accepted by `/schools/`
+MAX_LIMIT = int(os.environ.get("SCHOOLS_MAX_LIMIT", 10000))
+
+# Milliseconds a statement of a request may run before Postgres cancels it, 0 to disable
+STATEMENT_TIMEOUT = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT", 30000))
+
+# Planner cost of the page query, plus the count query for `count=exact`, above which `/schools/`
+# requests are rejected before they run, 0 to disable. Checking it costs an `EXPLAIN` for every
+# request which is not answered from the snapshot or the response cache.
+MAX_COST = float(os.environ.get("SCHOOLS_MAX_COST", 0))
+
+# SQLSTATE of statements cancelled by `statement_timeout`
+QUERY_CANCELED = "57014"
+
+
+def is_statement_timeout(error: DBAPIError) -> bool:
+    return getattr(error.orig, "pgcode", None) == QUERY_CANCELED
+
+
+class Limiter:
+    """Bounds the number of concurrent requests of one class of endpoints. Requests
+       beyond the limit are turned away immediately instead of waiting for a connection."""
+
+    def __init__(self, name: str, limit: int, retry_after: int):
+        self.name = name
+        self.limit = limit
+        self.retry_after = retry_after
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.active >= self.limit:
+                metrics.REJECTED_REQUESTS.labels(self.name).inc()
+                return False
+            self.active += 1
+        metrics.ACTIVE_REQUESTS.labels(self.name).inc()
+        return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        metrics.ACTIVE_REQUESTS.labels(self.name).dec()
+
+    def acquire_or_reject(self):
+        if not self.try_acquire():
+            raise HTTPException(status_code=503, detail="Too many concurrent requests, please retry later.",
+                                headers={"Retry-After": str(self.retry_after)})
+
+
+# Connections of the pool which listings and exports leave to lookups of single schools
+LOOKUP_CONNECTIONS = int(os.environ.get("ADMISSION_LOOKUP_CONNECTIONS", 3))
+
+# Lookups of single schools are cheap and get enough room to stay fast while the
+# pool is busy with listings, exports get few slots as each holds a connection for long
+LOOKUPS = Limiter("lookups", int(os.environ.get("ADMISSION_LOOKUPS", 100)), retry_after=1)
+EXPORTS = Limiter("exports", int(os.environ.get("ADMISSION_EXPORTS", 2)), retry_after=30)
+QUERIES = Limiter("queries", int(os.environ.get(
+    "ADMISSION_QUERIES",
+    max(1, database.POOL_SIZE + database.MAX_OVERFLOW - EXPORTS.limit - LOOKUP_CONNECTIONS))), retry_after=1)
+
+
+class Released(Iterator[T]):
+    """Iterates over `iterator` while holding a slot of `limiter`. The slot is given back once
+       the iterator is exhausted, failed or closed, or when the stream is garbage collected
+       without ever being started, e.g. as the client went away before the first chunk."""
+
+    def __init__(self, limiter: Limiter, iterator: Iterator[T]):
+        self._limiter = limiter
+        self._iterator = iterator
+        self._lock = threading.Lock()
+        self._released = False
+
+    def __next__(self) -> T:
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        try:
+            close = getattr(self._iterator, "close", None)
+            if close is not None:
+                close()
+        finally:
+            self._limiter.release()
+
+    def __del__(self):
+        self.close()
+
+
+class ReleasingResponse(StreamingResponse):
+    """Streams a `Released` and closes it however the response ends. Background tasks are
+       skipped if the client disconnected, so they cannot be relied on to give the slot back."""
+
+    def __init__(self, content: Released, **kwargs):
+        super().__init__(content, **kwargs)
+        self._released = content
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self._released.close)
+
+
+def admit(limiter: Limiter):
+    """Returns a dependency which holds a slot of `limiter` while the endpoint runs"""
+
+    async def dependency():
+        limiter.acquire_or_reject()
+        try:
+            yield
+        finally:
+            limiter.release()
+
+    return dependency
@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Hashable
+
+from . import metrics
+
+_caches = weakref.WeakSet()
+
+
+class VersionedCache:
+    """A thread-safe LRU cache whose entries are only valid for one version
+       of the data. Storing or looking up an entry for a newer version drops
+       all entries of older versions."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def get(self, version: Hashable, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if version != self.version:
+                return default
+            try:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            except KeyError:
+                return default
+
+    def get_latest(self, key: Hashable, default: Any = None) -> Any:
+        """Returns the entry of the latest version stored, which may be outdated"""
+        with self._lock:
+            return self._entries.get(key, default)
+
+    def put(self, version: Hashable, key: Hashable, value: Any):
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.version = None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ExpiringValue:
+    """Holds a single value for `ttl` seconds"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entry = None
+        _caches.add(self)
+
+    def get(self, default: Any = None) -> Any:
+        entry = self._entry
+        if entry is None or time.monotonic() - entry[1] >= self.ttl:
+            return default
+        return entry[0]
+
+    def put(self, value: Any):
+        self._entry = (value, time.monotonic())
+
+    def clear(self):
+        self._entry = None
+
+
+class ByteCache:
+    """A thread-safe LRU cache bounded by the total size of its entries instead
+       of their number. Keys have to include the version of the data, entries of
+       older versions are only dropped once they are the least recently used."""
+
+    def __init__(self, maxbytes: int, name: str):
+        self.maxbytes = maxbytes
+        self.name = name
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        _caches.add(self)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+                value, _ = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                metrics.CACHE_REQUESTS.labels(self.name, "miss").inc()
+                return default
+            self.hits += 1
+            metrics.CACHE_REQUESTS.labels(self.name, "hit").inc()
+            return value
+
+    def put(self, key: Hashable, value: Any, size: int):
+        if size > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.maxbytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+            metrics.CACHE_SIZE.labels(self.name).set(self.size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            metrics.CACHE_SIZE.labels(self.name).set(0)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def etag(*parts) -> str:
+    """Builds a weak ETag from the `repr` of the given parts"""
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def clear_all():
+    """Empties every cache of this process"""
+    for cache in list(_caches):
+        cache.clear()
@@ -0,0 +1,75 @@
+import gzip
+from typing import Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # Brotli is only offered if the package is installed
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstd is only offered if the package is installed
+    zstandard = None
+
+# Bodies smaller than this are sent uncompressed, like `GZipMiddleware` does
+MINIMUM_SIZE = 500
+
+# Bodies are compressed once and then served from a `cache.ByteCache`, so the
+# levels favour size over speed more than per-request compression could
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 7
+ZSTD_LEVEL = 12
+
+
+def _compressors() -> dict:
+    # In order of preference if the client accepts several with the same weight
+    compressors = {}
+    if brotli is not None:
+        compressors["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+    if zstandard is not None:
+        compressors["zstd"] = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    compressors["gzip"] = lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return compressors
+
+
+COMPRESSORS = _compressors()
+
+
+def _weights(accept_encoding: str) -> dict:
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.lower()] = weight
+    return weights
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """Returns the best content coding of `COMPRESSORS` accepted by the client, or None to send
+       the body uncompressed"""
+    if not accept_encoding:
+        return None
+    weights = _weights(accept_encoding)
+    default = weights.get("*", 0.0)
+    best, best_weight = None, 0.0
+    for coding in COMPRESSORS:
+        weight = weights.get(coding, default)
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def compress(body: bytes, coding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """Returns the body compressed with `coding` and the coding actually used"""
+    if coding is None or len(body) < MINIMUM_SIZE:
+        return body, None
+    return COMPRESSORS[coding](body), coding
@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Optional
+
+from fastapi import Request, Response
+
+
+def validators(etag: str, last_modified: Optional[datetime] = None) -> Dict[str, str]:
+    """Returns the `ETag` and `Last-Modified` headers for a response.
+       Naive timestamps of the database are taken to be in UTC."""
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        if last_modified.tzinfo is None:
+            last_modified = last_modified.replace(tzinfo=timezone.utc)
+        headers["Last-Modified"] = format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)
+    return headers
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Uses the weak comparison, as required for `If-None-Match`
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag.removeprefix("W/")
+                                    for candidate in candidates)
+
+
+def _not_modified_since(if_modified_since: str, last_modified: Optional[str]) -> bool:
+    if last_modified is None:
+        return False
+    try:
+        return parsedate_to_datetime(last_modified) <= parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def is_conditional(request: Request) -> bool:
+    """Returns whether the client sent validators of a copy it already has"""
+    return "If-None-Match" in request.headers or "If-Modified-Since" in request.headers
+
+
+def not_modified(request: Request, headers: Dict[str, str]) -> Optional[Response]:
+    """Returns a `304 Not Modified` response if the client's copy, identified by
+       `If-None-Match` or `If-Modified-Since`, is still fresh."""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        fresh = _etag_matches(if_none_match, headers["ETag"])
+    elif "If-Modified-Since" in request.headers:
+        fresh = _not_modified_since(request.headers["If-Modified-Since"], headers.get("Last-Modified"))
+    else:
+        fresh = False
+    if fresh:
+        return Response(status_code=304, headers=headers)
+    return None
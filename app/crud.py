@@ -1,61 +1,325 @@
-from typing import List, Optional
+import json
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
 
+from sqlalchemy import String, and_, any_, case, func, literal, literal_column, select, true, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
 
-from . import models
+from . import models, pagination, render
 from .filters import SchoolFilter
-from .schemas import School
+from .schemas import School, SortOrder
 
 
-def get_school(db: Session, school_id: str) -> Optional[School]:
-    school = db \
-        .query(models.School) \
+# Fields of the `School` schema that are computed in SQL
+_COMPUTED_FIELDS = {
+    'latitude': func.ST_Y(models.School.location),
+    'longitude': func.ST_X(models.School.location),
+}
+
+# Fields that are part of every response
+REQUIRED_FIELDS = {'id', 'name'}
+
+
+def field_names(fields: Optional[Iterable[str]] = None, include_raw: bool = False) -> List[str]:
+    """Returns the names of the selected columns, ordered like the `School` schema.
+       By default all fields but `raw` are selected, so that the potentially large raw data is only
+       read from the database if requested."""
+    if fields is None:
+        fields = School.model_fields.keys() - {'raw'}
+    fields = set(fields) | REQUIRED_FIELDS
+    if include_raw:
+        fields.add('raw')
+    return [field for field in School.model_fields
+            if field in fields and (field in _COMPUTED_FIELDS or field in models.School.__mapper__.columns)]
+
+
+def _columns(fields: Optional[Iterable[str]] = None, include_raw: bool = False) -> list:
+    """Returns the columns needed to render `fields`, labeled and ordered like the `School` schema"""
+    return [_COMPUTED_FIELDS[field].label(field) if field in _COMPUTED_FIELDS else getattr(models.School, field)
+            for field in field_names(fields, include_raw)]
+
+
+def get_school(db: Session, school_id: str, fields: Optional[Iterable[str]] = None,
+               include_raw: bool = False) -> Optional[School]:
+    row = db \
+        .query(*_columns(fields, include_raw)) \
         .filter(models.School.id == school_id) \
         .first()
-    if school:
-        return School.from_db(school)
+    if row:
+        return School.from_row(row._mapping)
     return None
 
 
+def get_schools_by_ids(db: Session, school_ids: List[str], fields: Optional[Iterable[str]] = None,
+                       include_raw: bool = False) -> dict:
+    """Looks up all `school_ids` in one query. Returns the found schools keyed by their id."""
+    query = db \
+        .query(*_columns(fields, include_raw)) \
+        .filter(models.School.id == any_(literal(school_ids, ARRAY(String))))
+    return {row.id: dict(row._mapping) for row in query}
 
-def get_schools(db: Session, skip: int = 0, limit: int = 100, filter_params=None) -> List[School]:
-    query = db.query(models.School)
+
+def _schools_query(db: Session, skip: int, limit: int, filter_params, order_by: Optional[SortOrder],
+                   after: Optional[list], fields: Optional[Iterable[str]], include_raw: bool):
+    query = db.query(*_columns(fields, include_raw))
     school_filter = SchoolFilter(filter_params)
     query = school_filter.apply(query)
-    return [School.from_db(school) for school in query.offset(skip).limit(limit).all()]
+    if order_by is None:
+        query = school_filter.rank(query)
+    query = pagination.paginate(query, order_by or SortOrder.id, after)
+    return query.offset(skip).limit(limit)
 
 
-def get_stats(db: Session):
-    response = db.execute(text("""select
-        substring(id, 1, 2) as state,
-        count(*) as count,
-        max(update_timestamp)::date as last_updated
-from schools
-group by state
-order by state;"""))
-    return [row._mapping for row in response]
+def get_schools(db: Session, skip: int = 0, limit: int = 100, filter_params=None,
+                order_by: Optional[SortOrder] = None, after: Optional[list] = None,
+                fields: Optional[Iterable[str]] = None, include_raw: bool = False) -> List[dict]:
+    """Returns the matching schools ordered by `order_by` as plain dictionaries keyed like the
+       `School` schema. Without an explicit order, name searches are ranked by similarity first."""
+    query = _schools_query(db, skip, limit, filter_params, order_by, after, fields, include_raw)
+    return [dict(row._mapping) for row in query.all()]
+
+
+def get_schools_json(db: Session, skip: int = 0, limit: int = 100, filter_params=None,
+                     order_by: Optional[SortOrder] = None, after: Optional[list] = None,
+                     fields: Optional[Iterable[str]] = None) -> Tuple[bytes, int, Optional[dict]]:
+    """Like `get_schools`, but lets Postgres render the JSON response.
+       Returns the response body, the number of schools and the sort keys of the last school."""
+    query = _schools_query(db, skip, limit, filter_params, order_by, after, fields, False)
+    # Aggregates are not guaranteed to keep the order of a sorted subquery, so the rows are
+    # numbered by the ordering of the list query, which Postgres takes from the same sort or scan
+    ordinal = func.row_number().over(order_by=query.selectable._order_by_clauses).label('ordinal')
+    schools = query.add_columns(ordinal).subquery()
+    body, count, last_id, last_update_timestamp = db.execute(select(
+        func.coalesce('[' + func.string_agg(render.sql_school(schools.c),
+                                             aggregate_order_by(literal_column("','"), schools.c.ordinal)) + ']',
+                      '[]'),
+        func.count(),
+        func.array_agg(aggregate_order_by(schools.c.id, schools.c.ordinal.desc()))[1],
+        func.array_agg(aggregate_order_by(schools.c.update_timestamp, schools.c.ordinal.desc()))[1]
+        if 'update_timestamp' in schools.c else None,
+    )).one()
+    last_school = {"id": last_id, "update_timestamp": last_update_timestamp} if count else None
+    return body.encode(), count, last_school
+
+
+def iter_schools(db: Session, filter_params=None, include_raw: bool = False,
+                 batch_size: int = 1000) -> Iterator[School]:
+    """Yields all matching schools while only holding `batch_size` rows in memory
+       by reading them from a server-side cursor."""
+    query = db.query(*_columns(include_raw=include_raw))
+    school_filter = SchoolFilter(filter_params)
+    query = school_filter.apply(query)
+    query = pagination.paginate(query, SortOrder.id)
+    for row in query.yield_per(batch_size):
+        yield School.from_row(row._mapping)
+
+
+def get_school_version(db: Session, school_id: str) -> Optional[tuple]:
+    """Returns `(update_timestamp,)` of the school or None if it does not exist"""
+    row = db.query(models.School.update_timestamp).filter(models.School.id == school_id).first()
+    return tuple(row) if row else None
+
+
+def _count_query(db: Session, filter_params):
+    query = db.query(func.count()).select_from(models.School)
+    school_filter = SchoolFilter({key: value for key, value in (filter_params or {}).items() if key != 'around'})
+    return school_filter.apply(query)
+
+
+def count_schools(db: Session, filter_params=None) -> int:
+    """Returns the number of schools matching `filter_params`"""
+    return _count_query(db, filter_params).scalar()
+
 
+def explain(db: Session, query, analyze: bool = False) -> dict:
+    """Returns the top node of the JSON query plan of `query`"""
+    compiled = query.statement.compile(dialect=db.get_bind().dialect,
+                                       compile_kwargs={"render_postcompile": True})
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    plan = db.connection().exec_driver_sql(f"EXPLAIN ({options}) {compiled}", params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
 
-def _get_states(db: Session):
-    return [state for state, in db.execute(text("select distinct(substring(id, 1, 2)) from schools;"))]
 
+def estimate_schools_count(db: Session, filter_params=None) -> int:
+    """Returns the planner's estimate of the number of schools matching `filter_params`"""
+    query = SchoolFilter(filter_params or {}).apply(db.query(models.School.id))
+    return int(explain(db, query)["Plan"]["Plan Rows"])
 
-def _get_school_types(db: Session):
-    return [school_type for school_type, in
-            db.execute(text("select distinct(school_type) from schools where school_type is not null;"))
-            ]
 
+def estimate_schools_cost(db: Session, skip: int, limit: int, filter_params, order_by: Optional[SortOrder],
+                          after: Optional[list], fields: Optional[Iterable[str]], include_raw: bool,
+                          count: bool = False) -> float:
+    """Returns the planner's total cost of the list query of `get_schools`, plus the cost
+       of `count_schools` if `count` is set"""
+    query = _schools_query(db, skip, limit, filter_params, order_by, after, fields, include_raw)
+    cost = explain(db, query)["Plan"]["Total Cost"]
+    if count:
+        cost += explain(db, _count_query(db, filter_params))["Plan"]["Total Cost"]
+    return cost
 
-def _get_legal_status(db: Session):
-    return [school_type for school_type, in
-            db.execute(text("select distinct(legal_status) from schools where legal_status is not null;"))
-            ]
 
+def get_data_version(db: Session) -> tuple:
+    """Returns a cheap fingerprint of the `schools` table which changes
+       whenever the scrapers add, update or remove schools."""
+    last_update, count = db.execute(text("select max(update_timestamp), count(*) from schools;")).one()
+    return last_update, count
 
-def get_params(db):
-    return {
-        "state": _get_states(db),
-        "school_type": _get_school_types(db),
-        "legal_status": _get_legal_status(db)
+
+def sync_changes(db: Session):
+    """Brings the change registry up to date with `schools`. The first sync records the schools
+       with their `update_timestamp`, later ones record new, updated and re-added schools at the
+       time of the sync, and removed schools become tombstones."""
+    db.execute(func.pg_advisory_xact_lock(models.CHANGES_LOCK_ID).select())
+    seeded = db.execute(text("select exists (select from school_changes);")).scalar()
+    # Schools may arrive with an old or no timestamp, which mirrors have already passed
+    db.execute(text("""insert into school_changes (id, changed_at, update_timestamp, deleted)
+select id, case when :seeded then greatest(coalesce(update_timestamp, '1970-01-01'::timestamp), localtimestamp)
+                else coalesce(update_timestamp, '1970-01-01'::timestamp) end,
+       update_timestamp, false from schools
+on conflict (id) do update set
+    changed_at = greatest(excluded.changed_at, localtimestamp),
+    update_timestamp = excluded.update_timestamp,
+    deleted = false
+where school_changes.deleted
+   or school_changes.update_timestamp is distinct from excluded.update_timestamp;"""), {"seeded": seeded})
+    db.execute(text("""update school_changes set deleted = true, changed_at = localtimestamp
+where not deleted and not exists (select from schools where schools.id = school_changes.id);"""))
+    db.commit()
+
+
+def get_changes(db: Session, after: Optional[Tuple[datetime, str]] = None, limit: int = 1000,
+                include_raw: bool = False) -> List[dict]:
+    """Returns the changes after the checkpoint `after`, ordered by `(changed_at, id)`"""
+    change = models.SchoolChange
+    query = db.query(change.id.label('change_id'), change.changed_at, change.deleted,
+                     *_columns(include_raw=include_raw)) \
+        .select_from(change) \
+        .outerjoin(models.School, models.School.id == change.id)
+    if after is not None:
+        query = query.filter(tuple_(change.changed_at, change.id) > tuple_(*after))
+    rows = query.order_by(change.changed_at, change.id).limit(limit)
+    fields = field_names(include_raw=include_raw)
+    changes = []
+    for row in rows:
+        # Schools removed since the last sync are reported as deleted right away
+        deleted = row.deleted or row.id is None
+        changes.append({
+            "id": row.change_id,
+            "changed_at": row.changed_at,
+            "deleted": deleted,
+            "school": {field: row._mapping[field] for field in fields} if not deleted else None,
+        })
+    return changes
+
+
+def get_tile(db: Session, z: int, x: int, y: int, filter_params=None) -> bytes:
+    """Renders the schools within the given tile as Mapbox Vector Tile"""
+    envelope = func.ST_TileEnvelope(z, x, y)
+    query = db.query(
+        func.ST_AsMVTGeom(func.ST_Transform(models.School.location, 3857), envelope).label('geom'),
+        models.School.id,
+        models.School.name,
+        models.School.school_type,
+        models.School.legal_status,
+    ).filter(models.School.location.intersects(func.ST_Transform(envelope, 4326)))
+    school_filter = SchoolFilter(filter_params)
+    query = school_filter.apply(query)
+    features = query.subquery()
+    tile = db.execute(select(func.ST_AsMVT(features.table_valued(), 'schools', 4096, 'geom'))).scalar()
+    return bytes(tile) if tile else b''
+
+
+def get_clusters(db: Session, grid_size: float, filter_params=None) -> List[dict]:
+    """Groups the located schools into grid cells of `grid_size` degrees. Returns the number of
+       schools and their centroid per cell, and the school's id for cells with a single school."""
+    centroid = func.ST_Centroid(func.ST_Collect(models.School.location))
+    query = db.query(
+        func.count().label('count'),
+        func.ST_Y(centroid).label('latitude'),
+        func.ST_X(centroid).label('longitude'),
+        case((func.count() == 1, func.min(models.School.id))).label('id'),
+    ).filter(models.School.location.isnot(None))
+    query = SchoolFilter(filter_params or {}).apply(query)
+    query = query.group_by(func.ST_SnapToGrid(models.School.location, grid_size))
+    return [dict(row._mapping) for row in query]
+
+
+FACETS = ('state', 'school_type', 'legal_status')
+
+
+def get_facets(db: Session, filter_params=None) -> dict:
+    """Counts the schools matching `filter_params` per value of every facet in a single scan.
+       The count of a facet ignores the facet's own filter, so that it shows how many schools
+       each value would give in addition to or instead of the selected ones."""
+    school_filter = SchoolFilter({key: value for key, value in (filter_params or {}).items() if key != 'around'})
+    facet_conditions = {f.key: f.condition() for f in school_filter.used_filters if f.key in FACETS}
+    # Grouped and selected expressions have to be identical, which bind parameters would prevent
+    columns = {
+        'state': func.substr(models.School.id, literal_column('1'), literal_column('2')),
+        'school_type': models.School.school_type,
+        'legal_status': models.School.legal_status,
     }
+    counts = []
+    for facet in FACETS:
+        conditions = [condition for key, condition in facet_conditions.items() if key != facet]
+        counts.append(func.count().filter(and_(true(), *conditions)).label(f'{facet}_count'))
+    query = db.query(func.grouping(*columns.values()).label('grouping_set'),
+                     *(column.label(facet) for facet, column in columns.items()),
+                     *counts)
+    for f in school_filter.used_filters:
+        if f.key not in FACETS:
+            query = f.apply(query)
+    query = query.group_by(func.grouping_sets(*columns.values()))
+
+    # `grouping` sets the bits of the columns that are not part of the grouping set
+    grouping_sets = {0b011: 'state', 0b101: 'school_type', 0b110: 'legal_status'}
+    facets = {facet: [] for facet in FACETS}
+    for row in query:
+        facet = grouping_sets[row.grouping_set]
+        value, count = getattr(row, facet), getattr(row, f'{facet}_count')
+        if value is not None and count:
+            facets[facet].append({"value": value, "count": count})
+    for values in facets.values():
+        values.sort(key=lambda facet: (-facet["count"], facet["value"]))
+    return facets
+
+
+def get_summary(db: Session) -> dict:
+    """Computes the statistics per state and the distinct filter values
+       in a single scan of the `schools` table"""
+    response = db.execute(text("""select
+        grouping(substring(id, 1, 2), school_type, legal_status) as grouping_set,
+        substring(id, 1, 2) as state,
+        school_type,
+        legal_status,
+        count(*) as count,
+        max(update_timestamp)::date as last_updated
+from schools
+group by grouping sets ((substring(id, 1, 2)), (school_type), (legal_status))
+order by grouping_set, state, school_type, legal_status;"""))
+    stats = []
+    params = {"state": [], "school_type": [], "legal_status": []}
+    for row in response:
+        if row.grouping_set == 0b011:
+            stats.append({"state": row.state, "count": row.count, "last_updated": row.last_updated})
+            params["state"].append(row.state)
+        elif row.grouping_set == 0b101 and row.school_type is not None:
+            params["school_type"].append(row.school_type)
+        elif row.grouping_set == 0b110 and row.legal_status is not None:
+            params["legal_status"].append(row.legal_status)
+    return {"stats": stats, "params": params}
+
+
+def get_stats(db: Session):
+    return get_summary(db)["stats"]
+
+
+def get_params(db: Session):
+    return get_summary(db)["params"]
@@ -1,10 +1,74 @@
 import os
+from typing import Callable, NamedTuple, Optional, TypeVar
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import Engine, create_engine, event, make_url, text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from starlette.concurrency import run_in_threadpool
 
+from . import metrics
 
-engine = create_engine(os.environ.get("DATABASE_URL"))
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+T = TypeVar("T")
 
-Base = declarative_base()
\ No newline at end of file
+# Serve requests through an asyncpg based engine instead of psycopg2 in the threadpool
+ASYNC_DATABASE = os.environ.get("DATABASE_ASYNC", "").lower() in ("1", "true", "yes")
+
+
+# Default size of the connection pools, can be overridden per database with
+# `pool_size` and `max_overflow` parameters in its connection string
+POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 10))
+
+
+def async_url(url: str):
+    return make_url(url).set(drivername="postgresql+asyncpg")
+
+
+class Engines(NamedTuple):
+    engine: Engine
+    SessionLocal: sessionmaker
+    async_engine: Optional[AsyncEngine]
+    AsyncSessionLocal: Optional[async_sessionmaker]
+
+
+def create_engines(url: str, name: str) -> Engines:
+    """Creates the instrumented engine and session factory for the database at `url`, and their
+       async variants if `DATABASE_ASYNC` is set. Metrics are labelled with `name`."""
+    url = make_url(url)
+    pool_options = {"pool_size": int(url.query.get("pool_size", POOL_SIZE)),
+                    "max_overflow": int(url.query.get("max_overflow", MAX_OVERFLOW))}
+    url = url.difference_update_query(["pool_size", "max_overflow"])
+    sync_engine = create_engine(url, poolclass=metrics.InstrumentedQueuePool, pool_logging_name=name,
+                                **pool_options)
+    metrics.instrument_engine(sync_engine, name)
+    if not ASYNC_DATABASE:
+        return Engines(sync_engine, sessionmaker(autocommit=False, autoflush=False, bind=sync_engine), None, None)
+    async_name = "async" if name == "sync" else f"{name}-async"
+    asyncio_engine = create_async_engine(async_url(url), poolclass=metrics.InstrumentedAsyncAdaptedQueuePool,
+                                         pool_logging_name=async_name, **pool_options)
+    metrics.instrument_engine(asyncio_engine.sync_engine, async_name)
+    return Engines(sync_engine, sessionmaker(autocommit=False, autoflush=False, bind=sync_engine),
+                   asyncio_engine, async_sessionmaker(asyncio_engine, autoflush=False, expire_on_commit=False))
+
+
+engine, SessionLocal, async_engine, AsyncSessionLocal = create_engines(os.environ.get("DATABASE_URL"), "sync")
+
+Base = declarative_base()
+
+
+@event.listens_for(Session, "after_begin")
+def _set_statement_timeout(session, transaction, connection):
+    # Set per transaction, so that it does not stay on the pooled connection
+    timeout = session.info.get("statement_timeout")
+    if timeout:
+        connection.execute(text("SELECT set_config('statement_timeout', :timeout, true)"),
+                           {"timeout": f"{timeout}ms"})
+
+
+async def run(db, fn: Callable[..., T], *args, **kwargs) -> T:
+    """Calls `fn(session, *args, **kwargs)` with the synchronous session behind `db`.
+       For an `AsyncSession` the function runs on the event loop and its queries are
+       awaited through the async driver, otherwise it runs in the threadpool."""
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
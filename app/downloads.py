@@ -0,0 +1,157 @@
+import asyncio
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from typing import Callable, List, Optional
+
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, export
+from .schemas import ExportFormat, School, State
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet files are only built if pyarrow is installed
+    pyarrow = None
+
+# Builds files of all schools and of every state for download into this directory
+DOWNLOADS_DIR = os.environ.get("DOWNLOADS_DIR")
+ENABLED = DOWNLOADS_DIR is not None
+
+# Seconds between checks whether the data changed and the files have to be rebuilt
+REFRESH_INTERVAL = float(os.environ.get("DOWNLOADS_REFRESH", 300))
+
+MANIFEST = "manifest.json"
+
+# Number of older versions kept on disk
+KEEP_PREVIOUS = 1
+
+# Scope of the files with all schools
+NATIONAL = "DE"
+
+MEDIA_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "geojson": export.MEDIA_TYPES[ExportFormat.geojson],
+}
+
+
+def _sha1(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _write_geojson(path: str, schools: List[School]):
+    # A fixed mtime keeps the files and therefore their ETags identical for identical data
+    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+        for part in export._geojson(iter(schools), include_raw=False):
+            f.write(part.encode())
+
+
+def _write_parquet(path: str, schools: List[School]):
+    fields = crud.field_names()
+    types = {"latitude": pyarrow.float64(), "longitude": pyarrow.float64(),
+             "update_timestamp": pyarrow.timestamp("us")}
+    schema = pyarrow.schema([(field, types.get(field, pyarrow.string())) for field in fields])
+    rows = [school.model_dump(include=set(fields)) for school in schools]
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows, schema=schema), path, compression="zstd")
+
+
+def _writers() -> dict:
+    writers = {"geojson": ("geojson.gz", _write_geojson)}
+    if pyarrow is not None:
+        writers["parquet"] = ("parquet", _write_parquet)
+    return writers
+
+
+def _build(directory: str, db: Session, version: tuple) -> dict:
+    by_scope = {NATIONAL: []}
+    for school in crud.iter_schools(db, filter_params={}, include_raw=False):
+        by_scope[NATIONAL].append(school)
+        by_scope.setdefault(school.id[:2], []).append(school)
+    artifacts = []
+    for scope in [NATIONAL] + [state.value for state in State]:
+        for file_format, (extension, write) in _writers().items():
+            name = f"schools-{scope}.{extension}"
+            path = os.path.join(directory, name)
+            write(path, by_scope.get(scope, []))
+            artifacts.append({
+                "name": name,
+                "state": None if scope == NATIONAL else scope,
+                "format": file_format,
+                "size": os.path.getsize(path),
+                "etag": f'"{_sha1(path)}"',
+            })
+    last_update, count = version
+    return {"version": [last_update.isoformat() if last_update else None, count], "artifacts": artifacts}
+
+
+def _version_key(version: tuple) -> str:
+    last_update, count = version
+    return hashlib.sha1(repr((last_update.isoformat() if last_update else None, count)).encode()).hexdigest()[:16]
+
+
+def _remove_old_versions(directory: str):
+    # Other workers may still list the previous files until their next refresh
+    versions = [os.path.join(DOWNLOADS_DIR, entry) for entry in os.listdir(DOWNLOADS_DIR) if entry != ".lock"]
+    versions.sort(key=os.path.getmtime, reverse=True)
+    previous = [version for version in versions if version != directory][:KEEP_PREVIOUS]
+    for version in versions:
+        if version != directory and version not in previous:
+            shutil.rmtree(version, ignore_errors=True)
+
+
+_current: Optional[dict] = None
+
+
+def current() -> Optional[dict]:
+    """Returns the manifest of the latest files, or None if none were built (yet)"""
+    return _current
+
+
+def path(manifest: dict, artifact: dict) -> str:
+    return os.path.join(manifest["directory"], artifact["name"])
+
+
+def refresh(session_factory: Callable[[], Session]):
+    """Builds the files for the current data unless they exist. Only one worker builds them,
+       the others wait for it and use its files."""
+    global _current
+    with session_factory() as db:
+        version = crud.get_data_version(db)
+        directory = os.path.join(DOWNLOADS_DIR, _version_key(version))
+        if _current is not None and _current["directory"] == directory:
+            return
+        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+        with open(os.path.join(DOWNLOADS_DIR, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(os.path.join(directory, MANIFEST)):
+                building = f"{directory}.building"
+                shutil.rmtree(building, ignore_errors=True)
+                os.makedirs(building)
+                manifest = _build(building, db, version)
+                with open(os.path.join(building, MANIFEST), "w") as f:
+                    json.dump(manifest, f)
+                os.rename(building, directory)
+            _remove_old_versions(directory)
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+    manifest["directory"] = directory
+    _current = manifest
+
+
+async def keep_fresh(session_factory: Callable[[], Session]):
+    while True:
+        try:
+            await run_in_threadpool(refresh, session_factory)
+        except (SQLAlchemyError, OSError) as e:
+            print(f'Could not build the downloads: {e}')
+        await asyncio.sleep(REFRESH_INTERVAL)
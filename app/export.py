@@ -0,0 +1,91 @@
+import csv
+import io
+import json
+from typing import Callable, Iterator
+
+from sqlalchemy.orm import Session
+
+from . import crud
+from .schemas import ExportFormat, School
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv; charset=utf-8",
+    ExportFormat.geojson: "application/geo+json",
+}
+
+# Number of rows that are written to the response in one chunk
+CHUNK_SIZE = 500
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _to_dict(school: School, include_raw: bool) -> dict:
+    exclude = None if include_raw else {'raw'}
+    return school.model_dump(mode="json", exclude=exclude, exclude_none=True)
+
+
+def _ndjson(schools: Iterator[School], include_raw: bool) -> Iterator[str]:
+    for school in schools:
+        yield _dumps(_to_dict(school, include_raw)) + "\n"
+
+
+def _csv(schools: Iterator[School], include_raw: bool) -> Iterator[str]:
+    columns = [field for field in School.model_fields if include_raw or field != 'raw']
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    yield buffer.getvalue()
+    for school in schools:
+        buffer.seek(0)
+        buffer.truncate()
+        row = _to_dict(school, include_raw)
+        if 'raw' in row:
+            row['raw'] = _dumps(row['raw'])
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+
+def _geojson(schools: Iterator[School], include_raw: bool) -> Iterator[str]:
+    yield '{"type":"FeatureCollection","features":['
+    separator = ""
+    for school in schools:
+        properties = _to_dict(school, include_raw)
+        longitude = properties.pop('longitude', None)
+        latitude = properties.pop('latitude', None)
+        geometry = None
+        if longitude is not None and latitude is not None:
+            geometry = {"type": "Point", "coordinates": [longitude, latitude]}
+        feature = {"type": "Feature", "id": school.id, "geometry": geometry, "properties": properties}
+        yield separator + _dumps(feature)
+        separator = ","
+    yield "]}\n"
+
+
+_WRITERS = {
+    ExportFormat.ndjson: _ndjson,
+    ExportFormat.csv: _csv,
+    ExportFormat.geojson: _geojson,
+}
+
+
+def stream(session_factory: Callable[[], Session], export_format: ExportFormat,
+           filter_params: dict, include_raw: bool = False) -> Iterator[bytes]:
+    """Renders all schools matching `filter_params` in `export_format`.
+       The rows are read through a server-side cursor and sent in chunks of
+       `CHUNK_SIZE`, so memory usage does not depend on the size of the export."""
+    db = session_factory()
+    try:
+        schools = crud.iter_schools(db, filter_params=filter_params, include_raw=include_raw)
+        chunk = []
+        for part in _WRITERS[export_format](schools, include_raw):
+            chunk.append(part)
+            if len(chunk) >= CHUNK_SIZE:
+                yield "".join(chunk).encode()
+                chunk = []
+        if chunk:
+            yield "".join(chunk).encode()
+    finally:
+        db.close()
@@ -1,6 +1,7 @@
+from datetime import datetime, time
 from typing import List
 
-from sqlalchemy import func, asc
+from sqlalchemy import func, asc, or_
 from sqlalchemy.orm import Query
 
 from app import models
@@ -17,66 +18,99 @@ class Filter:
     def handles(cls, key: str) -> bool:
         return key in cls.supported_keys
 
-    @staticmethod
-    def apply(query: Query) -> Query:
-        pass
+    def condition(self):
+        """Returns the SQL condition of the filter, or None if it does not restrict the rows"""
+        return None
+
+    def apply(self, query: Query) -> Query:
+        condition = self.condition()
+        return query if condition is None else query.filter(condition)
+
+    def rank(self, query: Query) -> Query:
+        return query
 
 
 class StateFilter(Filter):
     supported_keys = ['state']
 
-    def apply(self, query):
+    def condition(self):
         names = [state.name for state in self.values]
-        return query.filter(models.School.state.in_(names))
+        return models.School.state.in_(names)
 
 
 class BasicFilter(Filter):
     supported_keys = ['school_type', 'legal_status']
 
-    def apply(self, query):
+    def condition(self):
         column_to_filter = getattr(models.School, self.key)
-        return query.filter(column_to_filter.in_(self.values))
+        return column_to_filter.in_(self.values)
 
 class TextMatchFilter(Filter):
+    """Matches substrings and, to tolerate typos, similar words. Both are
+       answered by the trigram index on the normalized name."""
     supported_keys = ['name']
 
-    def apply(self, query):
-        column_to_filter = getattr(models.School, self.key)
-        return query.filter(column_to_filter.icontains(self.values))
+    def condition(self):
+        column_to_filter = models.normalized_name(getattr(models.School, self.key))
+        term = models.normalized_name(self.values)
+        return or_(column_to_filter.contains(term), column_to_filter.op('%>')(term))
+
+    def rank(self, query):
+        column_to_filter = models.normalized_name(getattr(models.School, self.key))
+        term = models.normalized_name(self.values)
+        return query.order_by(func.word_similarity(term, column_to_filter).desc())
 
 class UpdateTimestampFilter(Filter):
     supported_keys = ['update_timestamp']
 
-    def apply(self, query):
-        return query.filter(models.School.update_timestamp > self.values)
+    def condition(self):
+        # Compare against a datetime, as asyncpg does not coerce dates to timestamps
+        after = datetime.combine(self.values, time.min)
+        return models.School.update_timestamp > after
 
 
 class BoundingBoxFilter(Filter):
     supported_keys = ['bounding_box']
 
-    def apply(self, query):
-        return query.filter(
-            models.School.location.intersects(
-                func.ST_MakeEnvelope(
-                    self.values['left'], self.values['bottom'],
-                    self.values['right'], self.values['top']
-                )
+    def condition(self):
+        return models.School.location.intersects(
+            func.ST_MakeEnvelope(
+                self.values['left'], self.values['bottom'],
+                self.values['right'], self.values['top']
             )
         )
 
 
+def _geography_point(values):
+    return func.geography(func.ST_SetSRID(func.ST_MakePoint(values['lon'], values['lat']), 4326))
+
+
 class LatLonSorter(Filter):
+    """Orders by the KNN operator `<->`, which walks the GiST index on
+       the location nearest first, and adds the distance in meters."""
     supported_keys = ['around']
 
     def apply(self, query):
-        point = f"SRID=4326;POINT({self.values['lat']} {self.values['lon']})"
-        return query.order_by(asc(func.ST_Distance(models.School.location, point)))
+        location = models.School.location_geography
+        point = _geography_point(self.values)
+        return query \
+            .add_columns(func.ST_Distance(location, point).label('distance_m')) \
+            .order_by(asc(location.op('<->')(point)))
+
+
+class RadiusFilter(Filter):
+    supported_keys = ['radius']
+
+    def condition(self):
+        point = _geography_point(self.values)
+        return func.ST_DWithin(models.School.location_geography, point, self.values['meters'])
 
 
 class SchoolFilter:
     filter_classes = [StateFilter,
                       BasicFilter,
                       LatLonSorter,
+                      RadiusFilter,
                       BoundingBoxFilter,
                       UpdateTimestampFilter,
                       TextMatchFilter
@@ -97,3 +131,9 @@ class SchoolFilter:
         for filter in self.used_filters:
             query = filter.apply(query)
         return query
+
+    def rank(self, query):
+        """Orders the query by relevance for filters that support it, e.g. name searches"""
+        for filter in self.used_filters:
+            query = filter.rank(query)
+        return query
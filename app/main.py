@@ -1,69 +1,164 @@
+import asyncio
+import math
+import os
+from contextlib import asynccontextmanager
 from datetime import datetime, date
-from typing import List, Optional
+from typing import Iterable, List, Optional, Tuple, Union
 
-from fastapi import Depends, FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
 from fastapi.openapi.utils import get_openapi
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import Session
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
-from . import crud, schemas
-from .database import SessionLocal
-from .schemas import State
+from . import (admission, cache, compression, conditional, crud, database, downloads, export, metrics, models,
+               pagination, render, replicas, schemas, singleflight, snapshot)
+from .database import ASYNC_DATABASE, AsyncSessionLocal, SessionLocal, async_engine, engine
+from .schemas import CountMode, ExportFormat, SortOrder, State
 
-app = FastAPI()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fails the startup if name searches cannot work, other objects are only reported
+    await run_in_threadpool(models.create_indexes, engine)
+    refreshers = []
+    if snapshot.ENABLED:
+        refreshers.append(asyncio.create_task(snapshot.keep_fresh(SessionLocal)))
+    if downloads.ENABLED:
+        refreshers.append(asyncio.create_task(downloads.keep_fresh(SessionLocal)))
+    if replicas.router.replicas:
+        await run_in_threadpool(replicas.router.check_all)
+        refreshers.append(asyncio.create_task(replicas.router.keep_checked()))
+    yield
+    for refresher in refreshers:
+        refresher.cancel()
+    await replicas.router.dispose()
+    if async_engine is not None:
+        await async_engine.dispose()
+    metrics.mark_process_dead()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+class _GZipMiddleware(GZipMiddleware):
+    """Leaves the files of `/downloads` alone, which are either compressed already
+       or have to be sent unchanged to answer `Range` requests"""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith("/downloads/"):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app.add_middleware(metrics.MetricsMiddleware, stage="app")
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag", "Last-Modified"],
 )
-app.add_middleware(GZipMiddleware)
-
-
-def get_db():
-    try:
-        db = SessionLocal()
-        yield db
-    finally:
-        db.close()
-
-
-@app.get("/schools/", response_model=List[schemas.School], response_model_exclude_none=True)
-def read_schools(skip: int = 0,
-                 limit: int = 100,
-                 state: Optional[List[State]] = Query(None),
-                 school_type: Optional[List[str]] = Query(None),
-                 legal_status: Optional[List[str]] = Query(None),
-                 name: Optional[str] = Query(None,
-                                             description="Allows searching for names of schools."
-                                                         "Searches for case-insensitive substrings."),
-                 by_lat: Optional[float] = Query(None,
-                                                 description="Allows ordering result by distance from a geographical point."
-                                                             "Must be used in combination with `by_lon`"
-                                                             "Value must be in CRS EPSG:4326"
-                                                 ),
-                 by_lon: Optional[float] = Query(None,
-                                                 description="Allows ordering result by distance from a geographical point. "
-                                                             "Must be used in combination with `by_lat`"
-                                                             "Value must be in CRS EPSG:4326"
-                                                 ),
-                 bb_top: Optional[float] = Query(None,
-                                                 description="Allows filtering results by bounding box."
-                                                             "Must be used in combination with `bb_bottom`, `bb_left` and `bb_right`"
-                                                             "Value must be in CRS EPSG:4326"
-                                                 ),
-                 bb_bottom: Optional[float] = Query(None,
-                                                    description="Allows filtering results by bounding box. See `bb_top` for details."),
-                 bb_left: Optional[float] = Query(None,
-                                                  description="Allows filtering results by bounding box. See `bb_top` for details."),
-                 bb_right: Optional[float] = Query(None,
-                                                   description="Allows filtering results by bounding box. See `bb_top` for details."),
-                 update_timestamp: Optional[date] = Query(None,
-                                                   description="Allows filtering to only results scraped after the given date."),
-                 include_raw: bool = False,
-                 db: Session = Depends(get_db)):
+app.add_middleware(_GZipMiddleware)
+app.add_middleware(metrics.MetricsMiddleware, stage="sent", record_duration=True)
+
+
+@app.exception_handler(DBAPIError)
+async def database_error(request: Request, exc: DBAPIError):
+    if not admission.is_statement_timeout(exc):
+        raise exc
+    return JSONResponse(status_code=503, content={"detail": "The query took too long, please retry later."},
+                        headers={"Retry-After": "5"})
+
+
+if ASYNC_DATABASE:
+    async def get_db():
+        """A session of a replica if there is a healthy one, for endpoints which only read"""
+        async with replicas.router.async_sessionmaker()() as db:
+            db.info["statement_timeout"] = admission.STATEMENT_TIMEOUT
+            yield db
+
+    async def get_primary_db():
+        async with AsyncSessionLocal() as db:
+            db.info["statement_timeout"] = admission.STATEMENT_TIMEOUT
+            yield db
+else:
+    def get_db():
+        """A session of a replica if there is a healthy one, for endpoints which only read"""
+        try:
+            db = replicas.router.sessionmaker()()
+            db.info["statement_timeout"] = admission.STATEMENT_TIMEOUT
+            yield db
+        finally:
+            db.close()
+
+    def get_primary_db():
+        try:
+            db = SessionLocal()
+            db.info["statement_timeout"] = admission.STATEMENT_TIMEOUT
+            yield db
+        finally:
+            db.close()
+
+
+# Seconds for which the data version is reused instead of asking the database on every request
+data_version_cache = cache.ExpiringValue(ttl=float(os.environ.get("DATA_VERSION_TTL", 5)))
+version_flight = singleflight.SingleFlight("version")
+
+
+async def get_data_version(db) -> tuple:
+    """Returns `crud.get_data_version`, which may be up to `DATA_VERSION_TTL` seconds old"""
+    version = data_version_cache.get()
+    if version is None:
+        version = await version_flight.do("version", lambda: database.run(db, crud.get_data_version))
+        data_version_cache.put(version)
+    return version
+
+
+def get_session_factory():
+    """Used by streaming endpoints which outlive the request scoped session of `get_db`"""
+    return replicas.router.sessionmaker()
+
+
+async def school_filter_params(state: Optional[List[State]] = Query(None),
+                         school_type: Optional[List[str]] = Query(None),
+                         legal_status: Optional[List[str]] = Query(None),
+                         name: Optional[str] = Query(None,
+                                                     description="Allows searching for names of schools. "
+                                                                 "Searches for case-insensitive substrings and similar "
+                                                                 "words, ignoring the spelling of umlauts. Unless "
+                                                                 "`order_by` is given, results are ranked by similarity."),
+                         by_lat: Optional[float] = Query(None,
+                                                         description="Allows ordering result by distance from a geographical point."
+                                                                     "Must be used in combination with `by_lon`"
+                                                                     "Value must be in CRS EPSG:4326"
+                                                         ),
+                         by_lon: Optional[float] = Query(None,
+                                                         description="Allows ordering result by distance from a geographical point. "
+                                                                     "Must be used in combination with `by_lat`"
+                                                                     "Value must be in CRS EPSG:4326"
+                                                         ),
+                         radius_m: Optional[float] = Query(None, gt=0,
+                                                           description="Only returns schools within the given distance "
+                                                                       "in meters from the point given by `by_lat` and `by_lon`."),
+                         bb_top: Optional[float] = Query(None,
+                                                         description="Allows filtering results by bounding box."
+                                                                     "Must be used in combination with `bb_bottom`, `bb_left` and `bb_right`"
+                                                                     "Value must be in CRS EPSG:4326"
+                                                         ),
+                         bb_bottom: Optional[float] = Query(None,
+                                                            description="Allows filtering results by bounding box. See `bb_top` for details."),
+                         bb_left: Optional[float] = Query(None,
+                                                          description="Allows filtering results by bounding box. See `bb_top` for details."),
+                         bb_right: Optional[float] = Query(None,
+                                                           description="Allows filtering results by bounding box. See `bb_top` for details."),
+                         update_timestamp: Optional[date] = Query(None,
+                                                                  description="Allows filtering to only results scraped after the given date."),
+                         ) -> dict:
     filter_params = {
         "state": state,
         "school_type": school_type,
@@ -75,6 +170,10 @@ def read_schools(skip: int = 0,
         if not (by_lon and by_lat):
             raise HTTPException(status_code=400, detail="To order by point, you need to provide by_lon and by_lat.")
         filter_params["around"] = {"lat": by_lat, "lon": by_lon}
+    if radius_m is not None:
+        if "around" not in filter_params:
+            raise HTTPException(status_code=400, detail="To filter by radius, you need to provide by_lon and by_lat.")
+        filter_params["radius"] = {"lat": by_lat, "lon": by_lon, "meters": radius_m}
     bounding_box = {
         "top": bb_top,
         "bottom": bb_bottom,
@@ -86,34 +185,477 @@ def read_schools(skip: int = 0,
         if bounding_box_count != 4:
             raise HTTPException(status_code=400, detail="To filter by bounding box, you need to provide all `bb_` values.")
         filter_params["bounding_box"] = bounding_box
-    schools = crud.get_schools(db, skip=skip, limit=limit, filter_params=filter_params)
-    if include_raw:
-        return schools
-    return [school.model_dump(exclude={'raw'}) for school in schools]
+    return filter_params
+
+
+def _validate_fields(fields: Iterable[str]) -> set:
+    requested = {field.strip() for field in fields if field.strip()}
+    unknown = requested - schemas.School.model_fields.keys()
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return requested
+
+
+async def school_fields(fields: Optional[str] = Query(None,
+                                                     description="Comma separated list of the fields to return, "
+                                                                 "e.g. `id,name,latitude,longitude`. "
+                                                                 "`id` and `name` are always included.")
+                        ) -> Optional[set]:
+    if fields is None:
+        return None
+    return _validate_fields(fields.split(","))
+
+
+@app.get("/schools/", response_model=List[schemas.School], response_model_exclude_none=True,
+         dependencies=[Depends(admission.admit(admission.QUERIES))])
+async def read_schools(request: Request,
+                       skip: int = Query(0, ge=0),
+                       limit: int = Query(100, gt=0, le=admission.MAX_LIMIT),
+                       cursor: Optional[str] = Query(None,
+                                                     description="Continues a listing after the last page. "
+                                                                 "Use the value of the `X-Next-Cursor` header "
+                                                                 "of the previous response. "
+                                                                 "Cannot be combined with `skip`, `by_lat` or `by_lon`."),
+                       order_by: Optional[SortOrder] = Query(None,
+                                                             description="Orders the result by `id` (default) or by "
+                                                                         "`update_timestamp`. Ties are broken by `id`. "
+                                                                         "Name searches must set it to be continued with a cursor."),
+                       include_raw: bool = False,
+                       count: CountMode = Query(CountMode.none,
+                                                description="Sends the number of matching schools in the "
+                                                            "`X-Total-Count` header. `exact` counts them with an "
+                                                            "extra query, `estimated` uses the counts of `/stats` "
+                                                            "or the query planner and may be off for combined filters."),
+                       filter_params: dict = Depends(school_filter_params),
+                       fields: Optional[set] = Depends(school_fields),
+                       db: Session = Depends(get_db)):
+    after = None
+    if cursor is not None:
+        if skip or "around" in filter_params:
+            raise HTTPException(status_code=400,
+                                detail="A cursor cannot be combined with `skip`, `by_lat` or `by_lon`.")
+        try:
+            cursor_order, after = pagination.decode_cursor(cursor)
+        except pagination.InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if order_by is not None and order_by != cursor_order:
+            raise HTTPException(status_code=400, detail="The cursor was created for a different `order_by`.")
+        order_by = cursor_order
+    if fields is not None and order_by is not None:
+        # The cursor is built from the values of the sort key
+        fields = fields | {order_by.value}
+    with_raw = include_raw or (fields is not None and 'raw' in fields)
+    current = snapshot.current()
+    if current is not None and (with_raw or not current.covers(filter_params, order_by, after)):
+        current = None
+    # The validators only depend on the whole table, so that checking them does not
+    # scan all matching schools on every page
+    version = current.version if current is not None else await get_data_version(db)
+    query = (_normalized(filter_params), skip, limit, order_by, tuple(after or ()), tuple(sorted(fields or ())),
+             include_raw, count)
+    headers = conditional.validators(cache.etag(version, query), version[0])
+    not_modified = conditional.not_modified(request, headers)
+    if not_modified is not None:
+        return not_modified
+    coding = compression.negotiate(request.headers.get("Accept-Encoding"))
+    key = (query, version, coding)
+
+    async def render_page():
+        # Selected only on a miss, as filtering and sorting the snapshot is not free either
+        selection = None
+        if current is not None:
+            selection = current.select(filter_params, order_by=order_by, after=after, skip=skip, limit=limit,
+                                       fields=fields)
+        body, page_headers = await _render_schools_page(db, selection, skip, limit, order_by, after, fields,
+                                                        include_raw, with_raw, count, filter_params)
+        # Brotli and zstd take long enough for large pages to hold up the other requests
+        body, content_coding = await run_in_threadpool(compression.compress, body, coding)
+        response_cache.put(key, (body, page_headers, content_coding), len(body))
+        return body, page_headers, content_coding
+
+    cached = response_cache.get(key)
+    if cached is None:
+        cached = await schools_flight.do(key, render_page)
+    body, page_headers, content_coding = cached
+    headers.update(page_headers)
+    headers["Vary"] = "Accept-Encoding"
+    if content_coding is not None:
+        headers["Content-Encoding"] = content_coding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Identical requests arriving at the same time share their queries and the rendered page
+schools_flight = singleflight.SingleFlight("schools")
+
+# Compressed `/schools/` responses, which are skipped by `GZipMiddleware` as they set `Content-Encoding`
+response_cache = cache.ByteCache(maxbytes=int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024)),
+                                 name="schools")
+
+
+def _normalized(filter_params: dict) -> tuple:
+    """Returns the filter parameters in a form that is equal for requests with equal results,
+       e.g. regardless of the order of repeated query parameters"""
+    normalized = []
+    for key, value in sorted(filter_params.items()):
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = tuple(sorted({getattr(item, "value", item) for item in value}))
+        elif isinstance(value, dict):
+            value = tuple(sorted(value.items()))
+        normalized.append((key, value))
+    return tuple(normalized)
+
+
+async def _render_schools_page(db, selection, skip, limit, order_by, after, fields, include_raw, with_raw,
+                               count, filter_params) -> Tuple[bytes, dict]:
+    if admission.MAX_COST and selection is None:
+        # Only pages which are not served from the snapshot or a cache are priced
+        cost = await database.run(db, crud.estimate_schools_cost, skip=skip, limit=limit,
+                                  filter_params=filter_params, order_by=order_by, after=after, fields=fields,
+                                  include_raw=include_raw, count=count == CountMode.exact)
+        if cost > admission.MAX_COST:
+            raise HTTPException(status_code=400,
+                                detail="The request is too expensive. Add filters, lower `limit` "
+                                       "or leave out `include_raw`, or use `/schools/export`.")
+    headers = {}
+    if selection is not None and count != CountMode.none:
+        # The snapshot counts exactly without asking the database
+        headers["X-Total-Count"] = str(selection.total)
+    elif count == CountMode.exact:
+        headers["X-Total-Count"] = str(await database.run(db, crud.count_schools, filter_params=filter_params))
+    elif count == CountMode.estimated:
+        headers["X-Total-Count"] = str(await _estimate_count(db, filter_params))
+    if selection is not None:
+        schools = selection.rows
+        body, returned, last_school = render.render_schools(schools), len(schools), schools[-1] if schools else None
+    elif render.ENGINE == "postgres" and not with_raw:
+        body, returned, last_school = await database.run(
+            db, crud.get_schools_json, skip=skip, limit=limit, filter_params=filter_params,
+            order_by=order_by, after=after, fields=fields)
+    else:
+        schools = await database.run(db, crud.get_schools, skip=skip, limit=limit, filter_params=filter_params,
+                                     order_by=order_by, after=after, fields=fields, include_raw=include_raw)
+        body, returned, last_school = render.render_schools(schools), len(schools), schools[-1] if schools else None
+    # Distance and relevance orderings cannot be continued with a cursor
+    ranked = order_by is None and filter_params.get("name") is not None
+    if returned and returned == limit and "around" not in filter_params and not ranked:
+        headers["X-Next-Cursor"] = pagination.encode_cursor(order_by or SortOrder.id, last_school)
+    return body, headers
+
+
+async def _estimate_count(db, filter_params: dict) -> int:
+    used = {key for key, value in filter_params.items() if value is not None and key != "around"}
+    summary = summary_cache.get_latest("summary")
+    if summary is not None and used <= {"state"}:
+        # Reuse the per-state counts of /stats, even if they are slightly outdated
+        states = {state.value for state in filter_params.get("state") or State}
+        return sum(stat["count"] for stat in summary["stats"] if stat["state"] in states)
+    return await database.run(db, crud.estimate_schools_count, filter_params=filter_params)
+
+
+cluster_cache = cache.VersionedCache(maxsize=int(os.environ.get("CLUSTER_CACHE_SIZE", 64)))
 
+# Cells are about this many pixels wide on a map of the requested zoom level
+CLUSTER_CELL_PIXELS = 64
 
-@app.get("/schools/{school_id}", response_model=schemas.School, response_model_exclude_none=True)
-def read_school(school_id: str, include_raw: bool = False, db: Session = Depends(get_db)):
-    db_school = crud.get_school(db, school_id=school_id)
+# Clusters within a bounding box are computed and cached for tiles of this many cells in each
+# direction, so that panning the map mostly reuses them
+CLUSTER_TILE_CELLS = 8
+
+
+def _cluster_cells(bounding_box: dict, grid_size: float) -> Tuple[tuple, dict]:
+    """Returns the range of cells touched by `bounding_box` as `(left, right, bottom, top)` and
+       the envelope of the tiles containing them. `ST_SnapToGrid` puts a school into the cell of
+       the nearest multiple of `grid_size`, so cell `i` spans half a `grid_size` around `i * grid_size`."""
+    left, right = sorted((bounding_box["left"], bounding_box["right"]))
+    bottom, top = sorted((bounding_box["bottom"], bounding_box["top"]))
+    cells = (math.ceil(left / grid_size - 0.5), math.floor(right / grid_size + 0.5),
+             math.ceil(bottom / grid_size - 0.5), math.floor(top / grid_size + 0.5))
+    first_x, first_y = (cell // CLUSTER_TILE_CELLS * CLUSTER_TILE_CELLS for cell in cells[::2])
+    last_x, last_y = (cell // CLUSTER_TILE_CELLS * CLUSTER_TILE_CELLS + CLUSTER_TILE_CELLS - 1
+                      for cell in cells[1::2])
+    envelope = {
+        "left": (first_x - 0.5) * grid_size,
+        "right": (last_x + 0.5) * grid_size,
+        "bottom": (first_y - 0.5) * grid_size,
+        "top": (last_y + 0.5) * grid_size,
+    }
+    return cells, envelope
+
+
+@app.get("/schools/clusters", response_model=List[schemas.Cluster], response_model_exclude_none=True,
+         dependencies=[Depends(admission.admit(admission.QUERIES))])
+async def read_clusters(request: Request, response: Response,
+                        zoom: int = Query(..., ge=0, le=22,
+                                          description="Zoom level of the map, which determines the size of the cells."),
+                        grid_size: Optional[float] = Query(None, gt=0,
+                                                           description="Size of the cells in degrees. "
+                                                                       "Overrides the size derived from `zoom`."),
+                        filter_params: dict = Depends(school_filter_params),
+                        db: Session = Depends(get_db)):
+    """Returns the number of schools and their centroid for the cells of a grid, e.g. to draw
+       clusters on a map. The bounding box selects the cells it touches, which count all their
+       schools, also those outside of the box. Clusters are computed and cached per zoom level
+       for the tiles of cells around the box."""
+    if grid_size is None:
+        grid_size = CLUSTER_CELL_PIXELS * 360 / (256 * 2 ** zoom)
+    cells = None
+    bounding_box = filter_params.pop("bounding_box", None)
+    if bounding_box is not None:
+        cells, filter_params["bounding_box"] = _cluster_cells(bounding_box, grid_size)
+    filter_params.pop("around", None)
+    key = (grid_size, repr(sorted((key, value) for key, value in filter_params.items() if value is not None)))
+    version = await get_data_version(db)
+    headers = conditional.validators(cache.etag(version, key, cells), version[0])
+    headers["Cache-Control"] = "public, max-age=300"
+    not_modified = conditional.not_modified(request, headers)
+    if not_modified is not None:
+        return not_modified
+    response.headers.update(headers)
+    clusters = cluster_cache.get(version, key)
+    if clusters is None:
+        clusters = await database.run(db, crud.get_clusters, grid_size, filter_params=filter_params)
+        cluster_cache.put(version, key, clusters)
+    if cells is not None:
+        # The centroid lies within the cell of its schools
+        left, right, bottom, top = cells
+        clusters = [cluster for cluster in clusters
+                    if left <= math.floor(cluster["longitude"] / grid_size + 0.5) <= right
+                    and bottom <= math.floor(cluster["latitude"] / grid_size + 0.5) <= top]
+    return clusters
+
+
+@app.get("/schools/facets", response_model=schemas.Facets, dependencies=[Depends(admission.admit(admission.QUERIES))])
+async def read_facets(request: Request, response: Response,
+                      filter_params: dict = Depends(school_filter_params),
+                      db: Session = Depends(get_db)):
+    """Returns how many schools match the filters of `/schools/` per `state`, `school_type`
+       and `legal_status`. The counts of each facet ignore the filter on the facet itself."""
+    version = await get_data_version(db)
+    headers = conditional.validators(cache.etag(version, sorted(request.query_params.multi_items())), version[0])
+    not_modified = conditional.not_modified(request, headers)
+    if not_modified is not None:
+        return not_modified
+    response.headers.update(headers)
+    return await database.run(db, crud.get_facets, filter_params=filter_params)
+
+
+# Seconds between syncs of the change registry. The sync compares every school, as edits that
+# keep the largest `update_timestamp` and the number of schools do not change the data version.
+changes_synced = cache.ExpiringValue(ttl=float(os.environ.get("CHANGES_SYNC_INTERVAL", 10)))
+sync_flight = singleflight.SingleFlight("changes")
+
+
+@app.get("/schools/changes", response_model=schemas.ChangeFeed, response_model_exclude_none=True,
+         dependencies=[Depends(admission.admit(admission.QUERIES))])
+async def read_changes(checkpoint: Optional[str] = Query(None,
+                                                         description="Continues the feed after the last page. "
+                                                                     "Use the `checkpoint` of the previous response, "
+                                                                     "leave it out to start from the beginning."),
+                       limit: int = Query(1000, gt=0, le=10000),
+                       include_raw: bool = False,
+                       db: Session = Depends(get_primary_db)):
+    """Lists added, updated and removed schools ordered by the time the change was recorded
+       (`changed_at`) and `id`, for mirrors which only want to download changes. Removed schools are reported with
+       `op=delete` at the time their removal was noticed. Store the returned `checkpoint`
+       and pass it on the next call; it is returned unchanged if nothing changed."""
+    after = None
+    if checkpoint is not None:
+        try:
+            after = pagination.decode_checkpoint(checkpoint)
+        except pagination.InvalidCursor as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    # Updating the registry needs the primary, which is why this endpoint does not use a replica
+    if changes_synced.get() is None:
+        await sync_flight.do("sync", lambda: database.run(db, crud.sync_changes))
+        changes_synced.put(True)
+    changes = await database.run(db, crud.get_changes, after=after, limit=limit, include_raw=include_raw)
+    if changes:
+        checkpoint = pagination.encode_checkpoint(changes[-1]["changed_at"], changes[-1]["id"])
+    return Response(content=render.render_changes(changes, checkpoint, has_more=len(changes) == limit),
+                    media_type="application/json")
+
+
+@app.get("/schools/export", response_class=StreamingResponse)
+def export_schools(format: ExportFormat = ExportFormat.ndjson,
+                   include_raw: bool = False,
+                   filter_params: dict = Depends(school_filter_params),
+                   session_factory=Depends(get_session_factory)):
+    """Streams all schools matching the filters of `/schools/` as newline delimited JSON,
+       CSV or a GeoJSON FeatureCollection."""
+    # Held until the stream ended, not only until the endpoint returned
+    admission.EXPORTS.acquire_or_reject()
+    stream = admission.Released(admission.EXPORTS, export.stream(session_factory, format, filter_params, include_raw))
+    return admission.ReleasingResponse(
+        stream,
+        media_type=export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="schools.{format.value}"'},
+    )
+
+
+@app.post("/schools/batch", response_model=schemas.BatchResponse, response_model_exclude_none=True,
+          dependencies=[Depends(admission.admit(admission.QUERIES))])
+async def read_schools_batch(batch: schemas.BatchRequest, db: Session = Depends(get_db)):
+    """Looks up many schools by their id at once. Schools are returned in the order of `ids`,
+       ids without a school are listed in `not_found`."""
+    fields = _validate_fields(batch.fields) if batch.fields is not None else None
+    school_ids = list(dict.fromkeys(batch.ids))
+    found = await database.run(db, crud.get_schools_by_ids, school_ids, fields=fields, include_raw=batch.include_raw)
+    schools = [found[school_id] for school_id in school_ids if school_id in found]
+    not_found = [school_id for school_id in school_ids if school_id not in found]
+    return Response(content=render.render_batch(schools, not_found), media_type="application/json")
+
+
+@app.get("/schools/{school_id}", response_model=schemas.School, response_model_exclude_none=True,
+         dependencies=[Depends(admission.admit(admission.LOOKUPS))])
+async def read_school(request: Request, response: Response, school_id: str, include_raw: bool = False,
+                      fields: Optional[set] = Depends(school_fields),
+                      db: Session = Depends(get_db)):
+    def validators(last_update: Optional[datetime]) -> dict:
+        return conditional.validators(cache.etag(school_id, last_update, include_raw, sorted(fields or [])),
+                                      last_update)
+
+    # Only clients which already have a copy pay for probing its version first
+    if conditional.is_conditional(request):
+        version = await database.run(db, crud.get_school_version, school_id=school_id)
+        if version is None:
+            raise HTTPException(status_code=404, detail="School not found")
+        not_modified = conditional.not_modified(request, validators(*version))
+        if not_modified is not None:
+            return not_modified
+    selected = fields | {"update_timestamp"} if fields is not None else None
+    db_school = await database.run(db, crud.get_school, school_id=school_id, fields=selected,
+                                   include_raw=include_raw)
     if db_school is None:
         raise HTTPException(status_code=404, detail="School not found")
-    if include_raw:
-        return db_school
-    return db_school.model_dump(exclude={'raw'})
+    response.headers.update(validators(db_school.update_timestamp))
+    if fields is not None and "update_timestamp" not in fields:
+        db_school.update_timestamp = None
+    return db_school
+
 
+tile_cache = cache.VersionedCache(maxsize=int(os.environ.get("TILE_CACHE_SIZE", 4096)))
 
-@app.get("/stats", response_model=List[schemas.Statistic])
-def get_stats(db: Session = Depends(get_db)):
+
+@app.get("/tiles/{z}/{x}/{y}.mvt", response_class=Response, dependencies=[Depends(admission.admit(admission.QUERIES))],
+         responses={200: {"content": {"application/vnd.mapbox-vector-tile": {}}}})
+async def read_tile(request: Request, z: int, x: int, y: int,
+                    state: Optional[List[State]] = Query(None),
+                    school_type: Optional[List[str]] = Query(None),
+                    legal_status: Optional[List[str]] = Query(None),
+                    db: Session = Depends(get_db)):
+    """Returns the schools within the given tile as Mapbox Vector Tile with a
+       `schools` layer. Tiles use the Web Mercator tiling scheme (EPSG:3857)."""
+    if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        raise HTTPException(status_code=400, detail="Tile coordinates out of range.")
+    filter_params = {
+        "state": state,
+        "school_type": school_type,
+        "legal_status": legal_status,
+    }
+    key = (z, x, y, tuple(sorted(s.value for s in state or [])),
+           tuple(sorted(school_type or [])), tuple(sorted(legal_status or [])))
+    version = await get_data_version(db)
+    headers = conditional.validators(cache.etag(version, key), version[0])
+    headers["Cache-Control"] = "public, max-age=300"
+    not_modified = conditional.not_modified(request, headers)
+    if not_modified is not None:
+        return not_modified
+    tile = tile_cache.get(version, key)
+    if tile is None:
+        tile = await database.run(db, crud.get_tile, z, x, y, filter_params=filter_params)
+        tile_cache.put(version, key, tile)
+    return Response(content=tile, media_type="application/vnd.mapbox-vector-tile", headers=headers)
+
+
+summary_cache = cache.VersionedCache(maxsize=1)
+summary_flight = singleflight.SingleFlight("summary")
+
+# /stats and /filter_params only change after the scrapers ran
+SUMMARY_CACHE_CONTROL = "public, max-age=60"
+
+
+async def _get_summary(request: Request, response: Response, db) -> Union[dict, Response]:
+    version = await get_data_version(db)
+    headers = conditional.validators(cache.etag(version), version[0])
+    headers["Cache-Control"] = SUMMARY_CACHE_CONTROL
+    not_modified = conditional.not_modified(request, headers)
+    if not_modified is not None:
+        return not_modified
+    response.headers.update(headers)
+    summary = summary_cache.get(version, "summary")
+    if summary is None:
+        summary = await summary_flight.do(("summary", version), lambda: database.run(db, crud.get_summary))
+        summary_cache.put(version, "summary", summary)
+    return summary
+
+
+@app.get("/stats", response_model=List[schemas.Statistic], dependencies=[Depends(admission.admit(admission.QUERIES))])
+async def get_stats(request: Request, response: Response, db: Session = Depends(get_db)):
     """Returns the total count of schools grouped by state.
        States are represented using their ISO-3166-2:DE codes """
-    return crud.get_stats(db)
+    summary = await _get_summary(request, response, db)
+    if isinstance(summary, Response):
+        return summary
+    return summary["stats"]
 
 
-@app.get("/filter_params", response_model=schemas.Params)
-def get_filter_params(db: Session = Depends(get_db)):
+@app.get("/filter_params", response_model=schemas.Params,
+         dependencies=[Depends(admission.admit(admission.QUERIES))])
+async def get_filter_params(request: Request, response: Response, db: Session = Depends(get_db)):
     """Returns distinct values for keys that can be used as
        filters.py in the `/schools/` endpoint"""
-    return crud.get_params(db)
+    summary = await _get_summary(request, response, db)
+    if isinstance(summary, Response):
+        return summary
+    return summary["params"]
+
+
+@app.get("/downloads", response_model=List[schemas.Download], response_model_exclude_none=True)
+async def read_downloads(request: Request):
+    """Lists files with all schools and with the schools of each state as Parquet and gzipped
+       GeoJSON. They are rebuilt after the scrapers ran and are much cheaper to download than
+       paging through `/schools/`. The list is empty while the files are built."""
+    manifest = downloads.current()
+    if manifest is None:
+        return []
+    return [{**artifact, "url": str(request.url_for("read_download", name=artifact["name"])),
+             "last_updated": manifest["version"][0]}
+            for artifact in manifest["artifacts"]]
+
+
+@app.get("/downloads/{name}", response_class=FileResponse,
+         responses={200: {"content": {"application/vnd.apache.parquet": {}, "application/geo+json": {}}}})
+async def read_download(request: Request, name: str):
+    """Sends a file listed by `/downloads`. Supports `Range` requests to resume downloads.
+       GeoJSON is sent gzip-encoded to clients accepting it, and as `.gz` file otherwise."""
+    manifest = downloads.current()
+    artifact = next((artifact for artifact in manifest["artifacts"] if artifact["name"] == name), None) \
+        if manifest is not None else None
+    if artifact is None:
+        raise HTTPException(status_code=404, detail="Download not found")
+    last_update = manifest["version"][0]
+    headers = conditional.validators(artifact["etag"], datetime.fromisoformat(last_update) if last_update else None)
+    headers["Cache-Control"] = "public, max-age=300"
+    not_modified = conditional.not_modified(request, headers)
+    if not_modified is not None:
+        return not_modified
+    path = downloads.path(manifest, artifact)
+    if artifact["format"] != "geojson":
+        return FileResponse(path, media_type=downloads.MEDIA_TYPES[artifact["format"]], filename=name,
+                            headers=headers)
+    headers["Vary"] = "Accept-Encoding"
+    if "gzip" not in request.headers.get("Accept-Encoding", ""):
+        return FileResponse(path, media_type="application/gzip", filename=name, headers=headers)
+    headers["Content-Encoding"] = "gzip"
+    return FileResponse(path, media_type=downloads.MEDIA_TYPES["geojson"], filename=name.removesuffix(".gz"),
+                        headers=headers)
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
 
 
 def custom_openapi():
@@ -0,0 +1,159 @@
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# With several uvicorn workers every process writes its metrics to this directory
+# and /metrics aggregates them. It has to be emptied before the workers start.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+REQUEST_DURATION = Histogram("jedeschule_request_duration_seconds",
+                             "Time until the response was sent, per route",
+                             ["route", "method", "status"])
+RESPONSE_SIZE = Histogram("jedeschule_response_size_bytes",
+                          "Size of the response body as rendered by the app and as sent after compression",
+                          ["route", "stage"], buckets=SIZE_BUCKETS)
+SQL_DURATION = Histogram("jedeschule_sql_duration_seconds",
+                         "Time spent executing SQL statements",
+                         ["engine", "statement"])
+POOL_WAIT = Histogram("jedeschule_pool_checkout_wait_seconds",
+                      "Time spent waiting for a connection from the pool",
+                      ["engine"], buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+POOL_SIZE = Gauge("jedeschule_pool_size", "Connections kept open by the pool",
+                  ["engine"], multiprocess_mode="livesum")
+POOL_CHECKED_OUT = Gauge("jedeschule_pool_checked_out", "Connections currently in use",
+                         ["engine"], multiprocess_mode="livesum")
+POOL_OVERFLOW = Gauge("jedeschule_pool_overflow", "Connections opened beyond the pool size",
+                      ["engine"], multiprocess_mode="livesum")
+CACHE_REQUESTS = Counter("jedeschule_cache_requests_total", "Lookups in the response caches",
+                         ["cache", "result"])
+CACHE_SIZE = Gauge("jedeschule_cache_size_bytes", "Size of the entries kept by the response caches",
+                   ["cache"], multiprocess_mode="livesum")
+SINGLEFLIGHT_CALLS = Counter("jedeschule_singleflight_calls_total",
+                             "Calls which ran a query (leader) or waited for an identical one in flight (coalesced)",
+                             ["flight", "role"])
+ACTIVE_REQUESTS = Gauge("jedeschule_admitted_requests", "Requests currently holding a slot, per endpoint class",
+                        ["limiter"], multiprocess_mode="livesum")
+REJECTED_REQUESTS = Counter("jedeschule_rejected_requests_total",
+                            "Requests turned away as all slots of their endpoint class were taken",
+                            ["limiter"])
+
+# Only keep the kind of statement as label, not the statement itself
+_STATEMENTS = {"select", "insert", "update", "delete", "explain", "with", "create"}
+
+
+class _InstrumentedPool:
+    @property
+    def metrics_name(self) -> str:
+        # Set through `pool_logging_name`, which survives `Pool.recreate()`
+        return self._orig_logging_name or "default"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.labels(self.metrics_name).observe(time.perf_counter() - start)
+            self._update_gauges()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        POOL_SIZE.labels(self.metrics_name).set(self.size())
+        POOL_CHECKED_OUT.labels(self.metrics_name).set(self.checkedout())
+        POOL_OVERFLOW.labels(self.metrics_name).set(max(self.overflow(), 0))
+
+
+class InstrumentedQueuePool(_InstrumentedPool, QueuePool):
+    """A `QueuePool` which records how long checkouts wait for a
+       connection and how many connections are open and in use"""
+
+
+class InstrumentedAsyncAdaptedQueuePool(_InstrumentedPool, AsyncAdaptedQueuePool):
+    """The asyncio variant of `InstrumentedQueuePool`"""
+
+
+def instrument_engine(engine, name: str):
+    """Records the duration of every statement of `engine` (a sync engine or
+       `AsyncEngine.sync_engine`). Pool metrics need one of the instrumented pools."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        kind = statement.lstrip().split(None, 1)[0].lower() if statement.strip() else ""
+        SQL_DURATION.labels(name, kind if kind in _STATEMENTS else "other").observe(elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+
+def _route_name(scope) -> str:
+    # Plain starlette routes like /openapi.json only store their endpoint
+    route = scope.get("route") or scope.get("endpoint")
+    return getattr(route, "name", None) or getattr(route, "__name__", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """ASGI middleware measuring the response size at its position in the
+       middleware stack. Added inside and outside of `GZipMiddleware` it
+       shows the size before and after compression. The outer one also
+       records the request duration."""
+
+    def __init__(self, app, stage: str, record_duration: bool = False):
+        self.app = app
+        self.stage = stage
+        self.record_duration = record_duration
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_with_metrics(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            # The router stores the matched route in the shared scope
+            route = _route_name(scope)
+            RESPONSE_SIZE.labels(route, self.stage).observe(size)
+            if self.record_duration:
+                REQUEST_DURATION.labels(route, scope["method"], str(status)).observe(time.perf_counter() - start)
+
+
+def render() -> bytes:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_process_dead():
+    """Removes the gauges of this worker from the aggregated metrics"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
@@ -1,6 +1,9 @@
 from geoalchemy2 import Geometry
-from sqlalchemy import Column, String, JSON, func, DateTime
+from sqlalchemy import Boolean, Column, String, JSON, func, DateTime, Index, literal_column, DDL, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.schema import CreateIndex, CreateTable
 
 from .database import Base
 
@@ -35,3 +38,96 @@ class School(Base):
     def state(cls):
         return func.substr(cls.id, 1, 2)
 
+    @hybrid_property
+    def location_geography(self):
+        # Not used, see `state`
+        pass
+
+    @location_geography.expression
+    def location_geography(cls):
+        return func.geography(cls.location)
+
+
+class SchoolChange(Base):
+    """Registry of the schools the API has seen, owned by the API. Diffing it against
+       `schools` finds updated schools and keeps tombstones of removed ones."""
+    __tablename__ = 'school_changes'
+    id = Column(String, primary_key=True)
+    # The school's `update_timestamp`, or the time its removal was noticed
+    changed_at = Column(DateTime, nullable=False)
+    update_timestamp = Column(DateTime)
+    deleted = Column(Boolean, nullable=False, default=False)
+    __table_args__ = (Index('ix_school_changes_changed_at_id', 'changed_at', 'id'),)
+
+
+DDL_LOCK_ID = 20210519
+CHANGES_LOCK_ID = DDL_LOCK_ID + 1
+
+# Folds case, umlauts and ß, so that searching for "Strasse" finds "Straße".
+# The function is immutable and can therefore be used in the trigram index below.
+name_search_ddl = [
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+    DDL("""CREATE OR REPLACE FUNCTION normalize_school_name(name text) RETURNS text
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+    select translate(
+        replace(replace(replace(replace(replace(replace(replace(replace(lower(name),
+            'ä', 'ae'), 'Ä', 'ae'), 'ö', 'oe'), 'Ö', 'oe'), 'ü', 'ue'), 'Ü', 'ue'), 'ß', 'ss'), 'ẞ', 'ss'),
+        '-.,', '   ')
+$$"""),
+]
+for ddl in name_search_ddl:
+    event.listen(School.__table__, 'before_create', ddl)
+
+
+def normalized_name(value):
+    return func.normalize_school_name(value)
+
+
+# Indexes maintained by the API in addition to the ones created by the scrapers
+api_indexes = [
+    Index('ix_schools_update_timestamp_id',
+          func.coalesce(School.update_timestamp, literal_column("'infinity'::timestamp", DateTime)),
+          School.id),
+    Index('ix_schools_location_geography', School.location_geography, postgresql_using='gist'),
+    Index('ix_schools_name_trgm',
+          normalized_name(School.name).label('normalized_name'),
+          postgresql_using='gin',
+          postgresql_ops={'normalized_name': 'gin_trgm_ops'}),
+]
+
+
+def _execute_locked(engine: Engine, statements: list):
+    with engine.begin() as connection:
+        # Serialize concurrent startups of several workers
+        connection.execute(func.pg_advisory_xact_lock(DDL_LOCK_ID).select())
+        for statement in statements:
+            connection.execute(statement)
+
+
+def _name_search_exists(engine: Engine) -> bool:
+    with engine.connect() as connection:
+        return connection.execute(text(
+            "select to_regprocedure('normalize_school_name(text)') is not null "
+            "and exists (select from pg_extension where extname = 'pg_trgm')")).scalar()
+
+
+def create_indexes(engine: Engine):
+    """Creates the indexes and tables the API relies on if they are missing.
+       The `schools` table itself is owned by the migrations of the scrapers.
+       Raises if the name search function is missing and cannot be created, as name
+       searches fail without it. Other objects are created one transaction each and
+       only reported if they cannot be created."""
+    try:
+        _execute_locked(engine, name_search_ddl)
+    except SQLAlchemyError as e:
+        if not _name_search_exists(engine):
+            raise
+        print(f'Could not update the name search function, using the existing one: {e}')
+    statements = [('school_changes', CreateTable(SchoolChange.__table__, if_not_exists=True))]
+    for index in list(SchoolChange.__table__.indexes) + api_indexes:
+        statements.append((index.name, CreateIndex(index, if_not_exists=True)))
+    for name, statement in statements:
+        try:
+            _execute_locked(engine, [statement])
+        except SQLAlchemyError as e:
+            print(f'Could not create {name}: {e}')
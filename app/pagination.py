@@ -0,0 +1,87 @@
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Mapping, Optional, Tuple
+
+from sqlalchemy import DateTime, func, literal, literal_column, tuple_
+from sqlalchemy.orm import Query
+
+from app import models
+from app.schemas import SortOrder
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _timestamp_key(timestamp):
+    # Schools without a timestamp sort last. The same expression is indexed
+    # in `models`, which lets Postgres seek straight to the next page.
+    return func.coalesce(timestamp, literal_column("'infinity'::timestamp", DateTime))
+
+
+def _sort_keys(order: SortOrder):
+    if order == SortOrder.update_timestamp:
+        return [_timestamp_key(models.School.update_timestamp), models.School.id]
+    return [models.School.id]
+
+
+def _cursor_values(order: SortOrder, values: list):
+    if order == SortOrder.update_timestamp:
+        timestamp, school_id = values
+        return [_timestamp_key(literal(timestamp, DateTime)), school_id]
+    return values
+
+
+def paginate(query: Query, order: SortOrder, after: Optional[list] = None) -> Query:
+    """Orders the query by the keyset of `order` and, if given, only returns
+       rows that come after the keyset values `after`."""
+    keys = _sort_keys(order)
+    if after is not None:
+        query = query.filter(tuple_(*keys) > tuple_(*_cursor_values(order, after)))
+    return query.order_by(*keys)
+
+
+def encode_cursor(order: SortOrder, school: Mapping[str, Any]) -> str:
+    """Creates the cursor continuing after `school`, a row as returned by `crud.get_schools`"""
+    if order == SortOrder.update_timestamp:
+        timestamp = school['update_timestamp'].isoformat() if school['update_timestamp'] else None
+        values = [timestamp, school['id']]
+    else:
+        values = [school['id']]
+    payload = json.dumps({"o": order.value, "k": values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[SortOrder, List]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        order = SortOrder(payload["o"])
+        values = payload["k"]
+        if order == SortOrder.update_timestamp:
+            timestamp, school_id = values
+            if timestamp is not None:
+                timestamp = datetime.fromisoformat(timestamp)
+            values = [timestamp, str(school_id)]
+        else:
+            school_id, = values
+            values = [str(school_id)]
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+    return order, values
+
+
+def encode_checkpoint(changed_at: datetime, school_id: str) -> str:
+    """Creates the checkpoint continuing the change feed after the given change"""
+    payload = json.dumps({"t": changed_at.isoformat(), "i": school_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_checkpoint(checkpoint: str) -> Tuple[datetime, str]:
+    try:
+        padded = checkpoint + "=" * (-len(checkpoint) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(payload["t"]), str(payload["i"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursor(f"Invalid checkpoint: {checkpoint}") from e
@@ -0,0 +1,72 @@
+import os
+from typing import Iterable, Mapping, Optional
+
+import orjson
+from sqlalchemy import Float, String, case, func, literal, null
+from sqlalchemy.sql import ColumnCollection
+
+from .schemas import School
+
+# Renders `/schools/` lists in the API with orjson (`python`) or in the database (`postgres`)
+ENGINE = os.environ.get("SCHOOLS_RENDERER", "python")
+
+_FLOAT_FIELDS = {'latitude', 'longitude', 'distance_m'}
+
+
+def render_schools(rows: Iterable[Mapping]) -> bytes:
+    """Serializes rows as returned by `crud.get_schools` to the JSON of `List[schemas.School]`
+       with `response_model_exclude_none`, without creating or validating Pydantic models."""
+    return orjson.dumps([{key: value for key, value in row.items() if value is not None} for row in rows])
+
+
+def render_batch(schools: Iterable[Mapping], not_found: Iterable[str]) -> bytes:
+    """Serializes the result of a batch lookup like `render_schools`"""
+    return orjson.dumps({
+        "schools": [{key: value for key, value in row.items() if value is not None} for row in schools],
+        "not_found": list(not_found),
+    })
+
+
+def render_changes(changes: Iterable[Mapping], checkpoint: Optional[str], has_more: bool) -> bytes:
+    """Serializes a page of the change feed as returned by `crud.get_changes`, schools like `render_schools`"""
+    rendered = []
+    for change in changes:
+        item = {"op": "delete" if change["deleted"] else "upsert", "id": change["id"],
+                "changed_at": change["changed_at"]}
+        if not change["deleted"]:
+            item["school"] = {key: value for key, value in change["school"].items() if value is not None}
+        rendered.append(item)
+    return orjson.dumps({"changes": rendered, "checkpoint": checkpoint, "has_more": has_more})
+
+
+def _sql_float(value):
+    # Postgres prints integral floats without a fraction, Python as e.g. `52.0`
+    return case((value == func.trunc(value), func.trunc(value).cast(String) + '.0'),
+                else_=value.cast(Float).cast(String))
+
+
+def _sql_timestamp(value):
+    # Like `datetime.isoformat`, which omits the microseconds if they are zero
+    return '"' + func.to_char(value, 'YYYY-MM-DD"T"HH24:MI:SS') \
+        + case((func.to_char(value, 'US') == '000000', ''), else_=func.to_char(value, '.US')) + '"'
+
+
+def sql_school(columns: ColumnCollection):
+    """Builds the SQL expression rendering one school to the same JSON as `render_schools`.
+       `concat_ws` skips NULL values, which omits fields that are not set."""
+    members = []
+    for field in School.model_fields:
+        if field not in columns:
+            continue
+        if field == 'raw':
+            raise ValueError("The raw data is stored as is and cannot be rendered compactly by Postgres")
+        value = columns[field]
+        key = orjson.dumps(field).decode() + ':'
+        if field in _FLOAT_FIELDS:
+            rendered = _sql_float(value)
+        elif field == 'update_timestamp':
+            rendered = _sql_timestamp(value)
+        else:
+            rendered = func.to_json(value).cast(String)
+        members.append(case((value.is_(null()), null()), else_=literal(key) + rendered))
+    return '{' + func.concat_ws(',', *members) + '}'
@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import os
+import threading
+from typing import List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+from . import database
+from .database import Engines
+
+# Comma separated connection strings of read replicas, which serve the read-only endpoints
+READ_URLS = [url.strip() for url in os.environ.get("DATABASE_READ_URLS", "").split(",") if url.strip()]
+
+# `round_robin` or `least_connections`
+STRATEGY = os.environ.get("DATABASE_READ_STRATEGY", "round_robin")
+
+# Replicas further behind the primary than this many seconds are not used until they caught up
+MAX_LAG = float(os.environ.get("DATABASE_MAX_REPLICATION_LAG", 30))
+
+# Seconds between health checks of the replicas
+CHECK_INTERVAL = float(os.environ.get("DATABASE_HEALTH_INTERVAL", 10))
+
+# Zero if the replica replayed everything it received, as `pg_last_xact_replay_timestamp`
+# does not advance while nothing is written on the primary. NULL if it is not a replica.
+LAG_QUERY = text("""
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END
+""")
+
+
+class Replica:
+    def __init__(self, name: str, engines: Engines):
+        self.name = name
+        self.engines = engines
+        # Unused until the first health check succeeded
+        self.healthy = False
+        self.lag: Optional[float] = None
+        # A replica which lost its connection is skipped until the next check
+        event.listen(engines.engine, "handle_error", self._handle_error)
+        if engines.async_engine is not None:
+            event.listen(engines.async_engine.sync_engine, "handle_error", self._handle_error)
+
+    def _handle_error(self, context):
+        if context.is_disconnect:
+            self.healthy = False
+
+    def checked_out(self) -> int:
+        engine = self.engines.async_engine.sync_engine if self.engines.async_engine else self.engines.engine
+        return engine.pool.checkedout()
+
+    def check(self):
+        try:
+            with self.engines.engine.connect() as connection:
+                lag = connection.execute(LAG_QUERY).scalar()
+        except SQLAlchemyError as e:
+            if self.healthy:
+                print(f'Replica {self.name} is not available: {e}')
+            self.healthy, self.lag = False, None
+            return
+        self.lag = float(lag) if lag is not None else None
+        self.healthy = self.lag is not None and self.lag <= MAX_LAG
+
+
+class ReadRouter:
+    """Chooses the replica for each read-only session. Falls back to the primary
+       if there are no replicas or none of them is healthy."""
+
+    def __init__(self, replicas: List[Replica], strategy: str = "round_robin"):
+        if strategy not in ("round_robin", "least_connections"):
+            raise ValueError(f"Unknown read strategy: {strategy}")
+        self.replicas = replicas
+        self.strategy = strategy
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def choose(self) -> Optional[Replica]:
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        if self.strategy == "least_connections":
+            return min(healthy, key=Replica.checked_out)
+        with self._lock:
+            turn = next(self._turn)
+        return healthy[turn % len(healthy)]
+
+    def sessionmaker(self):
+        replica = self.choose()
+        return replica.engines.SessionLocal if replica is not None else database.SessionLocal
+
+    def async_sessionmaker(self):
+        replica = self.choose()
+        return replica.engines.AsyncSessionLocal if replica is not None else database.AsyncSessionLocal
+
+    def check_all(self):
+        for replica in self.replicas:
+            replica.check()
+
+    async def keep_checked(self):
+        while True:
+            await run_in_threadpool(self.check_all)
+            await asyncio.sleep(CHECK_INTERVAL)
+
+    async def dispose(self):
+        for replica in self.replicas:
+            if replica.engines.async_engine is not None:
+                await replica.engines.async_engine.dispose()
+            replica.engines.engine.dispose()
+
+
+router = ReadRouter([Replica(f"replica{i}", database.create_engines(url, f"replica{i}"))
+                     for i, url in enumerate(READ_URLS)], STRATEGY)
@@ -2,12 +2,9 @@ from __future__ import annotations
 
 from datetime import datetime, date
 from enum import Enum
-from typing import Optional, List
+from typing import Any, Mapping, Optional, List
 
-from geoalchemy2.shape import to_shape
-from pydantic import ConfigDict, BaseModel
-
-from app import models
+from pydantic import ConfigDict, BaseModel, Field
 
 
 class State(Enum):
@@ -29,6 +26,23 @@ class State(Enum):
     TH = 'TH'
 
 
+class ExportFormat(Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+    geojson = 'geojson'
+
+
+class SortOrder(Enum):
+    id = 'id'
+    update_timestamp = 'update_timestamp'
+
+
+class CountMode(Enum):
+    exact = 'exact'
+    estimated = 'estimated'
+    none = 'none'
+
+
 class School(BaseModel):
     id: str
     name: str
@@ -48,17 +62,70 @@ class School(BaseModel):
     zip: Optional[str] = None
     raw: Optional[dict] = None
     update_timestamp: Optional[datetime] = None
+    distance_m: Optional[float] = None
     model_config = ConfigDict(from_attributes=True)
 
     @staticmethod
-    def from_db(db_entry: models.School) -> School:
-        if not db_entry.location:
-            return School.model_validate(db_entry)
-        shape = to_shape(db_entry.location)
-        school = School.model_validate(db_entry)
-        school.latitude = shape.y
-        school.longitude = shape.x
-        return school
+    def from_row(row: Mapping[str, Any]) -> School:
+        """Creates a school from a (partial) row selected by `crud`"""
+        return School.model_validate(dict(row))
+
+
+class BatchRequest(BaseModel):
+    ids: List[str] = Field(max_length=5000)
+    include_raw: bool = False
+    fields: Optional[List[str]] = None
+
+
+class BatchResponse(BaseModel):
+    schools: List[School]
+    not_found: List[str]
+
+
+class Cluster(BaseModel):
+    latitude: float
+    longitude: float
+    count: int
+    id: Optional[str] = None
+
+
+class FacetCount(BaseModel):
+    value: str
+    count: int
+
+
+class Facets(BaseModel):
+    state: List[FacetCount]
+    school_type: List[FacetCount]
+    legal_status: List[FacetCount]
+
+
+class ChangeOperation(Enum):
+    upsert = 'upsert'
+    delete = 'delete'
+
+
+class Change(BaseModel):
+    op: ChangeOperation
+    id: str
+    changed_at: datetime
+    school: Optional[School] = None
+
+
+class ChangeFeed(BaseModel):
+    changes: List[Change]
+    checkpoint: Optional[str] = None
+    has_more: bool
+
+
+class Download(BaseModel):
+    name: str
+    state: Optional[State] = None
+    format: str
+    size: int
+    etag: str
+    url: str
+    last_updated: Optional[datetime] = None
 
 
 class Statistic(BaseModel):
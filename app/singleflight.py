@@ -0,0 +1,42 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+from . import metrics
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key within one process: the first
+       caller runs the function, callers arriving while it runs wait for its result
+       instead of sending the same queries to the database again."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        while True:
+            task = self._calls.get(key)
+            if task is None:
+                metrics.SINGLEFLIGHT_CALLS.labels(self.name, "leader").inc()
+                task = asyncio.ensure_future(fn())
+                self._calls[key] = task
+                task.add_done_callback(lambda done: self._forget(key, done))
+                # Cancelling the leader, e.g. as its client went away, cancels the call,
+                # as it uses the leader's session
+                return await task
+            metrics.SINGLEFLIGHT_CALLS.labels(self.name, "coalesced").inc()
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    raise
+                # The leader was cancelled, the next waiter takes over
+
+    def _forget(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
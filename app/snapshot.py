@@ -0,0 +1,197 @@
+import asyncio
+import os
+import sys
+from array import array
+from datetime import datetime, time, timedelta
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from . import crud, models, pagination
+from .schemas import SortOrder
+
+# Answers `/schools/` from an in-memory copy of the `schools` table instead of the database
+ENABLED = os.environ.get("SCHOOLS_SNAPSHOT", "").lower() in ("1", "true", "yes")
+
+# Seconds between checks whether the data changed and the snapshot has to be rebuilt
+REFRESH_INTERVAL = float(os.environ.get("SCHOOLS_SNAPSHOT_REFRESH", 60))
+
+# Filters evaluated in memory. Name searches (trigram similarity) and distances
+# (computed on the spheroid by PostGIS) cannot be reproduced exactly and are left
+# to the database.
+SUPPORTED_FILTERS = {"state", "school_type", "legal_status", "update_timestamp", "bounding_box"}
+
+_BITMAP_COLUMNS = ("state", "school_type", "legal_status")
+_FLOAT_COLUMNS = ("latitude", "longitude")
+_EPOCH = datetime(1970, 1, 1)
+# Lower than every timestamp, so that schools without one never match `update_timestamp`
+_NO_TIMESTAMP = -(1 << 63)
+# The set bits of every byte, used to turn bitmaps into row positions
+_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+def _micros(timestamp: Optional[datetime]) -> int:
+    if timestamp is None:
+        return _NO_TIMESTAMP
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _positions(bitmap: int, size: int) -> List[int]:
+    data = bitmap.to_bytes((size + 7) // 8, "little")
+    return [offset * 8 + bit for offset, byte in enumerate(data) if byte for bit in _BITS[byte]]
+
+
+class Selection(NamedTuple):
+    total: int
+    rows: List[dict]
+
+
+class Snapshot:
+    """A columnar copy of the `schools` table without `raw`.
+
+       Rows are stored in the order of `id` as sorted by the database, so that
+       results come out in the same order as from SQL regardless of the collation.
+       `state`, `school_type` and `legal_status` have a bitmap per value,
+       timestamps and coordinates are kept in arrays."""
+
+    def __init__(self, rows, timestamp_ranks: List[int]):
+        self.size = len(rows)
+        self.fields = crud.field_names()
+        self.columns: Dict[str, list] = {field: [] for field in self.fields if field not in _FLOAT_COLUMNS}
+        self.columns.update({field: array("d") for field in _FLOAT_COLUMNS})
+        self.timestamps = array("q")
+        self.timestamp_ranks = array("q", timestamp_ranks)
+        self.bitmaps: Dict[str, Dict[str, int]] = {column: {} for column in _BITMAP_COLUMNS}
+        self.positions: Dict[str, int] = {}
+        for position, row in enumerate(rows):
+            for field in self.fields:
+                value = row[field]
+                if field in _FLOAT_COLUMNS:
+                    value = float("nan") if value is None else value
+                elif isinstance(value, str):
+                    # Most values, e.g. types and cities, repeat a lot
+                    value = sys.intern(value)
+                self.columns[field].append(value)
+            for column, value in (("state", row["id"][:2]), ("school_type", row["school_type"]),
+                                  ("legal_status", row["legal_status"])):
+                if value is not None:
+                    bitmaps = self.bitmaps[column]
+                    bitmaps[value] = bitmaps.get(value, 0) | 1 << position
+            self.timestamps.append(_micros(row["update_timestamp"]))
+            self.positions[row["id"]] = position
+        timestamps = [timestamp for timestamp in self.columns["update_timestamp"] if timestamp is not None]
+        # Equal to `crud.get_data_version` at the time the rows were read
+        self.version = (max(timestamps, default=None), self.size)
+
+    @classmethod
+    def load(cls, db: Session) -> "Snapshot":
+        # Postgres decides the order of both keysets, see `pagination`
+        timestamp_rank = func.row_number().over(order_by=pagination._sort_keys(SortOrder.update_timestamp))
+        rows = db.query(*crud._columns(), timestamp_rank.label("timestamp_rank")) \
+            .order_by(models.School.id) \
+            .all()
+        return cls([row._mapping for row in rows], [row.timestamp_rank for row in rows])
+
+    def _match(self, filter_params: dict) -> List[int]:
+        bitmap = (1 << self.size) - 1
+        for column in _BITMAP_COLUMNS:
+            values = filter_params.get(column)
+            if values is None:
+                continue
+            if column == "state":
+                values = [state.name for state in values]
+            matching = 0
+            for value in values:
+                matching |= self.bitmaps[column].get(value, 0)
+            bitmap &= matching
+        positions = _positions(bitmap, self.size)
+
+        if filter_params.get("update_timestamp") is not None:
+            after = _micros(datetime.combine(filter_params["update_timestamp"], time.min))
+            timestamps = self.timestamps
+            positions = [position for position in positions if timestamps[position] > after]
+
+        bounding_box = filter_params.get("bounding_box")
+        if bounding_box is not None:
+            # Like ST_Intersects with the envelope, points on its border are included
+            left, right = sorted((bounding_box["left"], bounding_box["right"]))
+            bottom, top = sorted((bounding_box["bottom"], bounding_box["top"]))
+            latitudes, longitudes = self.columns["latitude"], self.columns["longitude"]
+            positions = [position for position in positions
+                         if left <= longitudes[position] <= right and bottom <= latitudes[position] <= top]
+        return positions
+
+    def _start_after(self, order: SortOrder, after: list) -> Optional[int]:
+        """Returns the sort key of the cursor's school, or None if it is not part of the snapshot"""
+        if order == SortOrder.update_timestamp:
+            timestamp, school_id = after
+            position = self.positions.get(school_id)
+            if position is None or self.columns["update_timestamp"][position] != timestamp:
+                return None
+            return self.timestamp_ranks[position]
+        return self.positions.get(after[0])
+
+    def covers(self, filter_params: dict, order_by: Optional[SortOrder] = None,
+               after: Optional[list] = None) -> bool:
+        """Returns whether `select` can answer the request without the database"""
+        used = {key for key, value in filter_params.items() if value is not None}
+        if not used <= SUPPORTED_FILTERS:
+            return False
+        return after is None or self._start_after(order_by or SortOrder.id, after) is not None
+
+    def select(self, filter_params: dict, order_by: Optional[SortOrder] = None, after: Optional[list] = None,
+               skip: int = 0, limit: int = 100, fields=None) -> Optional[Selection]:
+        """Evaluates a `/schools/` request like `crud.count_schools` and `crud.get_schools`.
+           Returns None if the request needs the database."""
+        if not self.covers(filter_params, order_by, after) or skip < 0 or limit < 0:
+            return None
+        positions = self._match(filter_params)
+        total = len(positions)
+
+        order = order_by or SortOrder.id
+        key = self.timestamp_ranks.__getitem__ if order == SortOrder.update_timestamp else None
+        if key is not None:
+            positions.sort(key=key)
+        if after is not None:
+            start = self._start_after(order, after)
+            positions = [position for position in positions if (key(position) if key else position) > start]
+
+        names = crud.field_names(fields)
+        rows = []
+        for position in positions[skip:skip + limit]:
+            row = {}
+            for name in names:
+                value = self.columns[name][position]
+                if name in _FLOAT_COLUMNS and value != value:
+                    value = None
+                row[name] = value
+            rows.append(row)
+        return Selection(total, rows)
+
+
+_current: Optional[Snapshot] = None
+
+
+def current() -> Optional[Snapshot]:
+    """Returns the latest snapshot, or None if none was loaded (yet)"""
+    return _current
+
+
+def refresh(session_factory: Callable[[], Session]):
+    """Rebuilds the snapshot if the data changed since it was loaded"""
+    global _current
+    with session_factory() as db:
+        if _current is None or _current.version != crud.get_data_version(db):
+            _current = Snapshot.load(db)
+
+
+async def keep_fresh(session_factory: Callable[[], Session]):
+    while True:
+        try:
+            await run_in_threadpool(refresh, session_factory)
+        except SQLAlchemyError as e:
+            print(f'Could not load the snapshot: {e}')
+        await asyncio.sleep(REFRESH_INTERVAL)
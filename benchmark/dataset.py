@@ -0,0 +1,155 @@
+"""Fills a local PostGIS database with a synthetic, but realistic set of schools.
+
+    python -m benchmark.dataset --schools 35000 --seed 1 --replace
+
+Uses the database given by `DATABASE_URL`. The data only depends on the
+seed, so results of different runs and branches can be compared.
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, text
+
+from app import models
+from app.database import Base, SessionLocal, engine
+from app.schemas import State
+
+# Approximate share of German schools per state and the area the schools are spread over
+STATES = {
+    State.NW: (0.170, [(51.23, 6.78), (50.94, 6.96), (51.51, 7.47), (51.96, 7.63), (52.02, 8.53)], 0.35),
+    State.BY: (0.140, [(48.14, 11.58), (49.45, 11.08), (48.37, 10.90), (49.01, 12.10), (49.79, 9.95)], 0.55),
+    State.BW: (0.135, [(48.78, 9.18), (49.49, 8.47), (48.00, 7.85), (49.01, 8.40), (48.40, 9.99)], 0.45),
+    State.NI: (0.090, [(52.38, 9.73), (53.14, 8.21), (52.27, 10.52), (52.28, 8.05), (51.54, 9.93)], 0.55),
+    State.HE: (0.058, [(50.11, 8.68), (49.87, 8.65), (51.31, 9.48), (50.08, 8.24), (50.58, 8.67)], 0.35),
+    State.SN: (0.045, [(51.34, 12.37), (51.05, 13.74), (50.83, 12.92), (51.18, 14.42)], 0.35),
+    State.RP: (0.045, [(49.99, 8.27), (50.36, 7.59), (49.75, 6.64), (49.48, 8.44), (49.44, 7.77)], 0.35),
+    State.BE: (0.030, [(52.52, 13.40)], 0.10),
+    State.SH: (0.027, [(54.32, 10.13), (53.87, 10.69), (54.78, 9.44), (54.09, 9.98)], 0.30),
+    State.TH: (0.027, [(50.98, 11.03), (50.93, 11.59), (50.88, 12.08), (50.98, 10.31)], 0.30),
+    State.BB: (0.027, [(52.40, 13.06), (51.76, 14.33), (52.34, 14.55), (52.41, 12.55)], 0.35),
+    State.ST: (0.027, [(52.13, 11.63), (51.48, 11.97), (51.84, 12.24), (51.90, 10.79)], 0.30),
+    State.MV: (0.018, [(54.09, 12.14), (53.63, 11.41), (54.09, 13.38), (53.56, 13.26)], 0.35),
+    State.HH: (0.014, [(53.55, 9.99)], 0.08),
+    State.SL: (0.009, [(49.24, 6.99), (49.35, 7.18), (49.44, 7.00)], 0.10),
+    State.HB: (0.006, [(53.08, 8.80), (53.54, 8.58)], 0.05),
+}
+
+SCHOOL_TYPES = [
+    ("Grundschule", 0.45), ("Gymnasium", 0.10), ("Förderschule", 0.09), ("Realschule", 0.07),
+    ("Gesamtschule", 0.06), ("Berufsbildende Schule", 0.08), ("Hauptschule", 0.05), ("Oberschule", 0.04),
+    ("Schule des zweiten Bildungswegs", 0.02), ("Waldorfschule", 0.01), (None, 0.03),
+]
+
+LEGAL_STATUS = [("in öffentlicher Trägerschaft", 0.88), ("in freier Trägerschaft", 0.10), (None, 0.02)]
+
+NAME_PATTERNS = [
+    "{type} {street}", "Städt. {type} {street}", "{type} am {place}", "{person}-{type}",
+    "{person}-Schule", "{type} {city}-{place}", "Private {type} {city}", "{place}schule",
+]
+PEOPLE = ["Albert-Schweitzer", "Anne-Frank", "Geschwister-Scholl", "Johann-Wolfgang-von-Goethe",
+          "Friedrich-Schiller", "Heinrich-Heine", "Käthe-Kollwitz", "Sophie-Scholl", "Astrid-Lindgren",
+          "Erich-Kästner", "Marie-Curie", "Alexander-von-Humboldt", "Theodor-Heuss", "Bertha-von-Suttner"]
+STREETS = ["Hauptstraße", "Schulstraße", "Bahnhofstraße", "Gartenstraße", "Lindenallee", "Kirchweg",
+           "Am Markt", "Bergstraße", "Waldstraße", "Pfälzer Str.", "Rosenweg", "Mühlenweg", "Parkstraße"]
+PLACES = ["Rosengarten", "Stadtpark", "Sonnenhang", "Lindenhof", "Mühlbach", "Eichenhain", "Wiesengrund",
+          "Schlossberg", "Rhein", "Elbufer", "Kiefernwald", "Marktplatz"]
+CITIES = ["Neustadt", "Altdorf", "Bergheim", "Waldkirchen", "Rosenheim", "Lindau", "Eichstätt",
+          "Friedberg", "Hohenstein", "Kirchberg", "Mühldorf", "Schönefeld"]
+
+
+def _pick(rng: random.Random, weighted):
+    values, weights = zip(*weighted)
+    return rng.choices(values, weights)[0]
+
+
+def _raw(rng: random.Random, school: dict) -> dict:
+    raw = {
+        "Schulnummer": school["id"][3:],
+        "Schulbezeichnung_1": school["name"],
+        "PLZ": school["zip"],
+        "Ort": school["city"],
+        "Strasse": school["address"],
+        "Telefon": school["phone"],
+        "E-Mail": school["email"],
+        "Homepage": school["website"],
+        "Rechtsform": "1" if school["legal_status"] == LEGAL_STATUS[0][0] else "2",
+        "Traegernummer": str(rng.randint(10000, 99999)),
+        "Gemeindeschluessel": f"{rng.randint(1000000, 16999999):08d}",
+        "Schulbetriebsdatum": f"01.08.{rng.randint(1950, 2020)}",
+    }
+    # The scrapers keep every column of the sources, whose number differs per state
+    for i in range(rng.randint(0, 20)):
+        raw[f"Feld_{i}"] = rng.choice(PLACES + STREETS + [""])
+    return raw
+
+
+def generate(count: int, seed: int = 1):
+    """Yields `count` schools as dictionaries of column values"""
+    rng = random.Random(seed)
+    now = datetime(2024, 6, 1)
+    total_share = sum(share for share, _, _ in STATES.values())
+    for state, (share, centers, spread) in STATES.items():
+        for n in range(max(1, round(count * share / total_share))):
+            school_type = _pick(rng, SCHOOL_TYPES)
+            lat, lon = rng.choice(centers)
+            city = rng.choice(CITIES)
+            school = {
+                "id": f"{state.value}-{n:05d}",
+                "name": rng.choice(NAME_PATTERNS).format(type=school_type or "Schule", street=rng.choice(STREETS),
+                                                         place=rng.choice(PLACES), person=rng.choice(PEOPLE),
+                                                         city=city),
+                "address": f"{rng.choice(STREETS)} {rng.randint(1, 120)}",
+                "address2": None,
+                "zip": f"{rng.randint(1067, 99998):05d}",
+                "city": city,
+                "website": f"https://schule-{state.value.lower()}-{n}.de" if rng.random() < 0.8 else None,
+                "email": f"{n}@schule.{state.value.lower()}.de" if rng.random() < 0.9 else None,
+                "school_type": school_type,
+                "legal_status": _pick(rng, LEGAL_STATUS),
+                "provider": f"Stadt {city}" if rng.random() < 0.7 else None,
+                "fax": None,
+                "phone": f"0{rng.randint(30, 9999)}{rng.randint(100000, 9999999)}" if rng.random() < 0.9 else None,
+                "director": None,
+                "update_timestamp": now - timedelta(seconds=rng.randint(0, 2 * 365 * 24 * 3600)),
+                # Clustered around the larger cities, as the real schools are
+                "location": f"POINT({rng.gauss(lon, spread):.6f} {rng.gauss(lat, spread * 0.65):.6f})"
+                            if rng.random() < 0.97 else None,
+            }
+            school["raw"] = _raw(rng, school)
+            yield school
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--schools", type=int, default=35000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--replace", action="store_true", help="Deletes all existing schools first")
+    parser.add_argument("--batch-size", type=int, default=2000)
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    models.create_indexes(engine)
+    with SessionLocal() as db:
+        if args.replace:
+            db.execute(text("TRUNCATE schools"))
+        batch = []
+        total = 0
+        for school in generate(args.schools, args.seed):
+            batch.append(school)
+            if len(batch) == args.batch_size:
+                db.execute(insert(models.School), batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            db.execute(insert(models.School), batch)
+            total += len(batch)
+        db.commit()
+        # Give the planner statistics for the new rows
+        db.execute(text("ANALYZE schools"))
+        db.commit()
+    print(f"Inserted {total} schools")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Sends concurrent requests for typical endpoint and filter combinations to a
+running API and reports latency percentiles and throughput per scenario.
+
+    python -m benchmark.dataset --replace
+    uvicorn app.main:app --workers 4 &
+    python -m benchmark.load --url http://localhost:8000 --output baseline.json
+    python -m benchmark.load --url http://localhost:8000 --compare baseline.json
+
+Each request draws its filters, offsets and cursors at random, so that the
+latencies reflect the work of the database rather than the caches. With
+`--repeat` every scenario sends one request over and over to measure cache hits.
+
+With `--compare` it exits with an error if the p95 latency of a scenario
+got worse than the baseline by more than `--tolerance`.
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Tuple
+from urllib.parse import quote
+
+import httpx
+
+from app import pagination
+from app.schemas import SortOrder, State
+from benchmark.dataset import CITIES, PEOPLE, PLACES, SCHOOL_TYPES, STATES
+
+# Number of schools generated by `benchmark.dataset` by default
+SCHOOLS = 35000
+
+NAME_TERMS = [term.split("-")[0].lower() for term in PEOPLE] + [term.lower() for term in PLACES + CITIES] + \
+             [school_type.lower() for school_type, _ in SCHOOL_TYPES if school_type]
+
+
+def _state(rng: random.Random) -> State:
+    return rng.choices(list(STATES), [share for share, _, _ in STATES.values()])[0]
+
+
+def _school_id(rng: random.Random) -> str:
+    state = _state(rng)
+    share = STATES[state][0] / sum(share for share, _, _ in STATES.values())
+    return f"{state.value}-{rng.randrange(max(1, round(SCHOOLS * share))):05d}"
+
+
+def _point(rng: random.Random) -> Tuple[float, float]:
+    lat, lon = rng.choice(STATES[_state(rng)][1])
+    return round(rng.gauss(lat, 0.2), 4), round(rng.gauss(lon, 0.3), 4)
+
+
+def _school_type(rng: random.Random) -> str:
+    return quote(rng.choice([school_type for school_type, _ in SCHOOL_TYPES if school_type]))
+
+
+def _bounding_box(rng: random.Random) -> str:
+    lat, lon = _point(rng)
+    size = rng.uniform(0.05, 0.3)
+    return f"bb_top={lat + size:.4f}&bb_bottom={lat - size:.4f}&bb_left={lon - size:.4f}&bb_right={lon + size:.4f}"
+
+
+def _typo(rng: random.Random, term: str) -> str:
+    position = rng.randrange(len(term))
+    return term[:position] + term[position + 1:]
+
+
+def _tile(rng: random.Random, zoom: int) -> str:
+    lat, lon = _point(rng)
+    x = int((lon + 180) / 360 * 2 ** zoom)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * 2 ** zoom)
+    return f"/tiles/{zoom}/{x}/{y}.mvt"
+
+
+def _cursor(rng: random.Random) -> str:
+    return pagination.encode_cursor(SortOrder.id, {"id": _school_id(rng)})
+
+
+# Every scenario draws the parameters of each request from a random generator, so that the
+# requests mostly miss the response and snapshot caches and measure the queries. The generator
+# is seeded per scenario, so that runs send the same requests and can be compared.
+SCENARIOS = {
+    "list": lambda rng: ("GET", f"/schools/?skip={rng.randrange(SCHOOLS)}", None),
+    "list_limit_1000": lambda rng: ("GET", f"/schools/?skip={rng.randrange(SCHOOLS)}&limit=1000", None),
+    "list_limit_10000": lambda rng: ("GET", f"/schools/?skip={rng.randrange(SCHOOLS)}&limit=10000", None),
+    "list_raw": lambda rng: ("GET", f"/schools/?skip={rng.randrange(SCHOOLS)}&limit=1000&include_raw=true", None),
+    "list_fields": lambda rng: ("GET", f"/schools/?skip={rng.randrange(SCHOOLS)}&limit=1000"
+                                       "&fields=latitude,longitude", None),
+    "list_offset": lambda rng: ("GET", f"/schools/?skip={rng.randrange(20000, 30000)}&limit=100", None),
+    "list_cursor": lambda rng: ("GET", f"/schools/?limit=100&cursor={_cursor(rng)}", None),
+    "state": lambda rng: ("GET", f"/schools/?state={_state(rng).value}&skip={rng.randrange(500)}&limit=1000", None),
+    "state_type": lambda rng: ("GET", f"/schools/?state={_state(rng).value}&school_type={_school_type(rng)}"
+                                      f"&skip={rng.randrange(100)}&limit=1000", None),
+    "name": lambda rng: ("GET", f"/schools/?name={quote(rng.choice(NAME_TERMS))}&skip={rng.randrange(100)}", None),
+    "name_typo": lambda rng: ("GET", f"/schools/?name={quote(_typo(rng, rng.choice(NAME_TERMS)))}", None),
+    "bounding_box": lambda rng: ("GET", f"/schools/?{_bounding_box(rng)}&limit=1000", None),
+    "around": lambda rng: ("GET", "/schools/?by_lat={}&by_lon={}&limit=20".format(*_point(rng)), None),
+    "around_radius": lambda rng: ("GET", "/schools/?by_lat={}&by_lon={}&radius_m={}&limit=1000".format(
+        *_point(rng), rng.randrange(1000, 10000, 100)), None),
+    "update_timestamp": lambda rng: ("GET", f"/schools/?update_timestamp="
+                                            f"{date(2022, 6, 1) + timedelta(days=rng.randrange(730))}&limit=1000",
+                                     None),
+    "count_exact": lambda rng: ("GET", f"/schools/?state={_state(rng).value}&school_type={_school_type(rng)}"
+                                       "&count=exact", None),
+    "school": lambda rng: ("GET", f"/schools/{_school_id(rng)}", None),
+    "batch": lambda rng: ("POST", "/schools/batch", {"ids": [_school_id(rng) for _ in range(1000)]}),
+    "clusters": lambda rng: ("GET", f"/schools/clusters?zoom={rng.randrange(6, 12)}&{_bounding_box(rng)}", None),
+    # Aggregates of the whole table, which are computed once per version of the data
+    "stats": lambda rng: ("GET", "/stats", None),
+    "filter_params": lambda rng: ("GET", "/filter_params", None),
+    "tile": lambda rng: ("GET", _tile(rng, rng.randrange(8, 13)), None),
+}
+
+
+def _percentile(latencies, percent):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+async def _run_scenario(client: httpx.AsyncClient, make_request: Callable, rng: random.Random, requests: int,
+                        concurrency: int):
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in pending:
+            method, path, body = make_request(rng)
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": round(requests / elapsed, 2),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def run(url: str, scenarios, requests: int, concurrency: int, warmup: int, seed: int,
+              repeat: bool = False) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results = {}
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60,
+                                 headers={"Accept-Encoding": "gzip"}) as client:
+        for name in scenarios:
+            make_request = SCENARIOS[name]
+            rng = random.Random(f"{seed}-{name}")
+            if repeat:
+                # Sends the first request over and over, which measures the caches instead
+                first = make_request(rng)
+                make_request = lambda _: first
+            for _ in range(warmup):
+                method, path, body = make_request(rng)
+                await client.request(method, path, json=body)
+            results[name] = await _run_scenario(client, make_request, rng, requests, concurrency)
+            print(f"{name:>18}: p50 {results[name]['p50_ms']:8.2f} ms, p95 {results[name]['p95_ms']:8.2f} ms, "
+                  f"p99 {results[name]['p99_ms']:8.2f} ms, {results[name]['throughput']:8.2f} req/s"
+                  + (f", {results[name]['errors']} errors" if results[name]['errors'] else ""))
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Prints the change of the p95 latency per scenario. Returns whether all are within `tolerance`."""
+    ok = True
+    for name, result in results.items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        change = result["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0
+        regressed = change > tolerance
+        ok = ok and not regressed
+        print(f"{name:>18}: p95 {before['p95_ms']:8.2f} -> {result['p95_ms']:8.2f} ms ({change:+.0%})"
+              + (" REGRESSION" if regressed else ""))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS, help="Only runs these scenarios")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the request parameters")
+    parser.add_argument("--repeat", action="store_true",
+                        help="Repeats the same request per scenario to measure cache hits instead of queries")
+    parser.add_argument("--output", help="Writes the results as JSON baseline to this file")
+    parser.add_argument("--compare", help="Compares the results with this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative p95 increase")
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+    results = asyncio.run(run(args.url, scenarios, args.requests, args.concurrency, args.warmup, args.seed,
+                              args.repeat))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": datetime.now(timezone.utc).isoformat(),
+                "revision": _git_revision(),
+                "python": platform.python_version(),
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "seed": args.seed,
+                "repeat": args.repeat,
+                "scenarios": results,
+            }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Checks the query plans of `/schools/` for every combination of filters.
+
+    python -m benchmark.plans                # checks against benchmark/plan_budgets.json
+    python -m benchmark.plans --strict       # also fails on combinations without a budget
+    python -m benchmark.plans --update       # records new budgets
+
+Runs `EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)` for the list query of every
+combination of `SchoolFilter.filter_classes` and fails if a plan scans the
+`schools` table sequentially or exceeds the cost or buffers of its budget.
+Combinations without a recorded budget are only checked for sequential scans,
+unless `--strict` is given, as the CI workflow does once budgets are committed.
+Uses the database given by `DATABASE_URL`, which should contain the schools
+of `benchmark.dataset`.
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import date
+from itertools import combinations
+from typing import Iterator, List, Tuple
+
+from app import crud
+from app.database import SessionLocal
+from app.filters import (BasicFilter, BoundingBoxFilter, LatLonSorter, RadiusFilter, SchoolFilter, StateFilter,
+                         TextMatchFilter, UpdateTimestampFilter)
+from app.schemas import State
+
+BUDGETS = os.path.join(os.path.dirname(__file__), "plan_budgets.json")
+
+# Budgets are recorded with some headroom, as costs and buffers vary slightly between runs
+HEADROOM = 1.5
+
+# Typical parameters for each filter, matching the schools of `benchmark.dataset`
+SAMPLE_PARAMS = {
+    StateFilter: {"state": [State.NW]},
+    BasicFilter: {"school_type": ["Gymnasium"], "legal_status": ["in freier Trägerschaft"]},
+    LatLonSorter: {"around": {"lat": 52.52, "lon": 13.40}},
+    RadiusFilter: {"radius": {"lat": 52.52, "lon": 13.40, "meters": 5000}},
+    BoundingBoxFilter: {"bounding_box": {"top": 52.6, "bottom": 52.4, "left": 13.2, "right": 13.6}},
+    UpdateTimestampFilter: {"update_timestamp": date(2024, 5, 1)},
+    TextMatchFilter: {"name": "grundschule"},
+}
+
+# Filters which the API only accepts together with another one
+REQUIRES = {
+    RadiusFilter: LatLonSorter,
+}
+
+
+def filter_combinations() -> Iterator[Tuple[str, dict]]:
+    """Yields a name and the filter parameters for every combination the API accepts"""
+    filter_classes = SchoolFilter.filter_classes
+    for size in range(len(filter_classes) + 1):
+        for combination in combinations(filter_classes, size):
+            if any(REQUIRES.get(fc, fc) not in combination for fc in combination):
+                continue
+            params = {}
+            for filter_class in combination:
+                params.update(SAMPLE_PARAMS[filter_class])
+            yield "+".join(fc.__name__ for fc in combination) or "unfiltered", params
+
+
+def _nodes(plan: dict) -> Iterator[dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _nodes(child)
+
+
+def measure(db, params: dict, limit: int = 100) -> dict:
+    query = crud._schools_query(db, skip=0, limit=limit, filter_params=params, order_by=None, after=None,
+                                fields=None, include_raw=False)
+    plan = crud.explain(db, query, analyze=True)["Plan"]
+    return {
+        "cost": plan["Total Cost"],
+        "buffers": plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0),
+        "time_ms": plan["Actual Total Time"],
+        "seq_scan": any(node["Node Type"] == "Seq Scan" and node.get("Relation Name") == "schools"
+                        for node in _nodes(plan)),
+    }
+
+
+def check(db, budgets: dict) -> Tuple[List[str], List[str]]:
+    """Returns a description of every combination with a sequential scan or over its budget,
+       and the names of the combinations without a budget, which are only checked for scans"""
+    failures, unbudgeted = [], []
+    for name, params in filter_combinations():
+        result = measure(db, params)
+        budget = budgets.get(name)
+        if result["seq_scan"]:
+            failures.append(f"{name}: sequential scan on schools")
+        if budget is None:
+            unbudgeted.append(name)
+            continue
+        for key in ("cost", "buffers"):
+            if result[key] > budget[key]:
+                failures.append(f"{name}: {key} {result[key]} over budget {budget[key]}")
+    return failures, unbudgeted
+
+
+def load_budgets() -> dict:
+    if not os.path.exists(BUDGETS):
+        return {}
+    with open(BUDGETS) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--update", action="store_true", help="Records the current plans as budgets")
+    parser.add_argument("--strict", action="store_true", help="Fails on combinations without a budget")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.update:
+            budgets = {}
+            for name, params in filter_combinations():
+                result = measure(db, params)
+                budgets[name] = {"cost": round(result["cost"] * HEADROOM, 2),
+                                 "buffers": int(result["buffers"] * HEADROOM) + 10}
+                print(f"{name}: {result}")
+            with open(BUDGETS, "w") as f:
+                json.dump(budgets, f, indent=2, sort_keys=True)
+            return
+        failures, unbudgeted = check(db, load_budgets())
+    for name in unbudgeted:
+        if args.strict:
+            failures.append(f"{name}: no budget, record one with --update")
+        else:
+            print(f"{name}: no budget, skipped the cost and buffers, record one with --update")
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print("No sequential scans, all budgeted plans within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Compares the CPU time the API process spends per `/schools/` page for each renderer.
+
+    python -m benchmark.renderers --limit 1000 --iterations 50
+
+Uses the database given by `DATABASE_URL`.
+"""
+import argparse
+import time
+
+from app import crud, render
+from app.database import SessionLocal
+
+
+def _python(db, limit):
+    return render.render_schools(crud.get_schools(db, limit=limit))
+
+
+def _postgres(db, limit):
+    body, _, _ = crud.get_schools_json(db, limit=limit)
+    return body
+
+
+RENDERERS = {
+    "python": _python,
+    "postgres": _postgres,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        for name, renderer in RENDERERS.items():
+            renderer(db, args.limit)  # warm up
+            cpu_start, wall_start = time.process_time(), time.perf_counter()
+            for _ in range(args.iterations):
+                size = len(renderer(db, args.limit))
+            cpu = (time.process_time() - cpu_start) / args.iterations * 1000
+            wall = (time.perf_counter() - wall_start) / args.iterations * 1000
+            print(f"{name:>8}: {cpu:7.2f} ms CPU, {wall:7.2f} ms wall per request ({size} bytes)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,31 @@
+import asyncio
+import csv
+import gc
+import io
+import json
 import os
 from datetime import datetime
 from typing import Iterator, Generator
 
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import NullPool
+from starlette.requests import ClientDisconnect
 
-from app.main import app, get_db
-from app.database import Base
+# Every test sees its own changes to the data immediately
+os.environ.setdefault("DATA_VERSION_TTL", "0")
+os.environ.setdefault("CHANGES_SYNC_INTERVAL", "0")
+
+from app import (admission, cache, compression, crud, database, downloads, metrics, models, render, replicas,
+                 singleflight, snapshot)
+from app.main import app, export_schools, get_db, get_primary_db, get_session_factory, response_cache
+from app.database import Base, Engines, async_url
 from app.models import School
+from app.schemas import ExportFormat
+from benchmark import plans
 from test.factory import SchoolFactory, get_full_school
 
 engine = create_engine(os.environ.get("DATABASE_URL_TEST"))
@@ -27,12 +43,15 @@ def override_get_db() -> Iterator[Session]:
 
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_primary_db] = override_get_db
+app.dependency_overrides[get_session_factory] = lambda: TestingSessionLocal
 
 
 @pytest.fixture(scope="function")
 def db() -> Generator:
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
+    cache.clear_all()
 
     yield TestingSessionLocal()
 
@@ -59,6 +78,20 @@ class TestStats:
             {"state": "NI", "count": 10, "last_updated": "2025-01-01"},
         ]
 
+    def test_stats_carry_cache_headers(self, client, db):
+        # Arrange
+        db.add(School(id="BE-1", update_timestamp=datetime(2024, 12, 24)))
+        db.commit()
+
+        # Act
+        first_response = client.get("/stats")
+        second_response = client.get("/stats")
+
+        # Assert
+        assert first_response.headers["Cache-Control"] == "public, max-age=60"
+        assert first_response.headers["ETag"].startswith('W/"')
+        assert first_response.headers["ETag"] == second_response.headers["ETag"]
+
 
 class TestFilterParams:
     def test_basic(self, client, db):
@@ -77,11 +110,27 @@ class TestFilterParams:
 
         # Assert
         assert response.status_code == 200
-        assert response.json() == {'legal_status': ['Staatlich', 'Privat'],
-                                   'school_type': ['IGS', 'Grundschule', 'Gesamtschule'],
-                                   'state': ['SN', 'NI', 'BY']
+        assert response.json() == {'legal_status': ['Privat', 'Staatlich'],
+                                   'school_type': ['Gesamtschule', 'Grundschule', 'IGS'],
+                                   'state': ['BY', 'NI', 'SN']
                                    }
 
+    def test_cache_is_invalidated_on_new_data(self, client, db):
+        # Arrange
+        db.add(SchoolFactory(id="BY-1", legal_status="Privat", school_type="Grundschule"))
+        db.commit()
+        first_response = client.get("/filter_params")
+        db.add(SchoolFactory(id="NI-1", legal_status="Staatlich", school_type="IGS"))
+        db.commit()
+
+        # Act
+        second_response = client.get("/filter_params")
+
+        # Assert
+        assert first_response.json()["state"] == ["BY"]
+        assert second_response.json()["state"] == ["BY", "NI"]
+        assert first_response.headers["ETag"] != second_response.headers["ETag"]
+
 
 class TestStates:
     def __setup_schools(self, db):
@@ -264,6 +313,22 @@ class TestStates:
             "longitude": 6.897017373118707,
         }
 
+    def test_list_renders_like_single_school(self, client, db):
+        # Arrange
+        school = get_full_school()
+        school.location = 'SRID=4326;POINT(6.897017373118707 50.94217152830834)'
+        school.update_timestamp = datetime(2024, 1, 1, 12, 30, 5, 123)
+        db.add(school)
+        db.commit()
+
+        # Act
+        list_response = client.get("/schools?include_raw=true")
+        single_response = client.get("/schools/NW-112586?include_raw=true")
+
+        # Assert
+        assert list_response.headers["content-type"] == "application/json"
+        assert list_response.content == b"[" + single_response.content + b"]"
+
     def test_schools_ordered_by_distance(self, client, db):
         # Arrange
         for school in [
@@ -276,13 +341,39 @@ class TestStates:
         db.commit()
 
         # Act
-        response = client.get("/schools?by_lat=9.99&by_lon=52.00&limit=1")
+        response = client.get("/schools?by_lat=50.00&by_lon=9.99&limit=1")
 
         # Assert
         assert response.status_code == 200
         schools = response.json()
         assert len(schools) == 1
         assert schools[0]['id'] == "BB-3"
+        assert schools[0]['distance_m'] == pytest.approx(717, abs=5)
+
+    def test_schools_within_radius(self, client, db):
+        # Arrange
+        for school in [
+            SchoolFactory.create(location=None, id="BE-0"),
+            SchoolFactory.create(location='SRID=4326;POINT(13.400 52.520)', id="BE-1"),
+            SchoolFactory.create(location='SRID=4326;POINT(13.405 52.520)', id="BE-2"),
+            SchoolFactory.create(location='SRID=4326;POINT(13.500 52.520)', id="BE-3"),
+        ]:
+            db.add(school)
+        db.commit()
+
+        # Act
+        response = client.get("/schools?by_lat=52.52&by_lon=13.404&radius_m=1000")
+
+        # Assert
+        assert response.status_code == 200
+        assert [school["id"] for school in response.json()] == ["BE-2", "BE-1"]
+
+    def test_radius_requires_point(self, client, db):
+        # Act
+        response = client.get("/schools?radius_m=1000")
+
+        # Assert
+        assert response.status_code == 400
 
     around_queries = [
         ("?by_lat=52", 400),
@@ -380,3 +471,1386 @@ class TestStates:
         # Assert
         assert response.status_code == 404
 
+
+
+class TestCursorPagination:
+    def __crawl(self, client, url):
+        ids = []
+        response = client.get(url)
+        while True:
+            assert response.status_code == 200
+            ids += [school["id"] for school in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                return ids
+            response = client.get(f"{url}&cursor={cursor}")
+
+    def test_follows_cursor_through_all_pages(self, client, db):
+        # Arrange
+        for school in [SchoolFactory(id=f"BE-{i}") for i in range(7)]:
+            db.add(school)
+        db.commit()
+
+        # Act
+        ids = self.__crawl(client, "/schools?limit=3")
+
+        # Assert
+        assert ids == sorted(f"BE-{i}" for i in range(7))
+
+    def test_keeps_filters(self, client, db):
+        # Arrange
+        for school in [SchoolFactory(id=f"BE-{i}") for i in range(4)] + \
+                      [SchoolFactory(id=f"NI-{i}") for i in range(3)]:
+            db.add(school)
+        db.commit()
+
+        # Act
+        ids = self.__crawl(client, "/schools?state=NI&limit=2")
+
+        # Assert
+        assert ids == ["NI-0", "NI-1", "NI-2"]
+
+    def test_orders_by_update_timestamp(self, client, db):
+        # Arrange
+        for school in [
+            SchoolFactory(id="BE-1", update_timestamp=datetime(2024, 1, 1)),
+            SchoolFactory(id="BE-2", update_timestamp=None),
+            SchoolFactory(id="BE-3", update_timestamp=datetime(2023, 1, 1)),
+            SchoolFactory(id="BE-4", update_timestamp=datetime(2024, 1, 1)),
+            SchoolFactory(id="BE-5", update_timestamp=None),
+        ]:
+            db.add(school)
+        db.commit()
+
+        # Act
+        ids = self.__crawl(client, "/schools?order_by=update_timestamp&limit=2")
+
+        # Assert
+        assert ids == ["BE-3", "BE-1", "BE-4", "BE-2", "BE-5"]
+
+    cursor_queries = [
+        ("?cursor=invalid", 400),
+        ("?cursor=eyJvIjoiaWQiLCJrIjpbIkJFLTEiXX0&skip=10", 400),
+        ("?cursor=eyJvIjoiaWQiLCJrIjpbIkJFLTEiXX0&by_lat=52&by_lon=10", 400),
+        ("?cursor=eyJvIjoiaWQiLCJrIjpbIkJFLTEiXX0&order_by=update_timestamp", 400),
+        ("?cursor=eyJvIjoiaWQiLCJrIjpbIkJFLTEiXX0", 200),
+    ]
+    @pytest.mark.parametrize("query_params,status_code", cursor_queries)
+    def test_cursor_param_validation(self, client, db, query_params, status_code):
+        # Act
+        response = client.get(f"/schools{query_params}")
+
+        # Assert
+        assert response.status_code == status_code
+
+
+class TestExport:
+    def __setup_schools(self, db):
+        for school in [
+            SchoolFactory(id="BE-1", name="Schule 1", location='SRID=4326;POINT(13.00 52.00)'),
+            SchoolFactory(id="BE-2", name="Schule 2", location=None),
+            SchoolFactory(id="NI-1", name="Schule 3", location=None),
+        ]:
+            db.add(school)
+        db.commit()
+
+    def test_ndjson(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/schools/export?state=BE")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["id"] for row in rows] == ["BE-1", "BE-2"]
+        assert rows[0]["latitude"] == 52.0
+        assert "raw" not in rows[0]
+
+    def test_csv(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/schools/export?format=csv")
+
+        # Assert
+        assert response.status_code == 200
+        rows = list(csv.DictReader(io.StringIO(response.text)))
+        assert [row["id"] for row in rows] == ["BE-1", "BE-2", "NI-1"]
+        assert rows[0]["longitude"] == "13.0"
+        assert "raw" not in rows[0]
+
+    def test_geojson(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/schools/export?format=geojson&include_raw=true")
+
+        # Assert
+        assert response.status_code == 200
+        collection = response.json()
+        assert collection["type"] == "FeatureCollection"
+        assert len(collection["features"]) == 3
+        assert collection["features"][0]["geometry"] == {"type": "Point", "coordinates": [13.0, 52.0]}
+        assert collection["features"][1]["geometry"] is None
+        assert collection["features"][0]["properties"]["name"] == "Schule 1"
+
+    def test_validates_filters(self, client, db):
+        # Act
+        response = client.get("/schools/export?bb_top=52")
+
+        # Assert
+        assert response.status_code == 400
+
+
+class TestTiles:
+    def __setup_schools(self, db):
+        for school in [
+            SchoolFactory(id="BE-1", school_type="Gymnasium", location='SRID=4326;POINT(13.40 52.52)'),
+            SchoolFactory(id="BE-2", school_type="Grundschule", location='SRID=4326;POINT(13.41 52.51)'),
+            SchoolFactory(id="BE-3", school_type="Grundschule", location=None),
+        ]:
+            db.add(school)
+        db.commit()
+
+    def test_tile_with_schools(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/tiles/10/550/335.mvt")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/vnd.mapbox-vector-tile"
+        assert b"schools" in response.content
+        assert b"BE-1" in response.content
+        assert b"BE-2" in response.content
+
+    def test_filters_tile(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/tiles/10/550/335.mvt?school_type=Gymnasium")
+
+        # Assert
+        assert response.status_code == 200
+        assert b"BE-1" in response.content
+        assert b"BE-2" not in response.content
+
+    def test_empty_tile(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/tiles/10/0/0.mvt")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.content == b""
+
+    def test_cache_is_invalidated_on_new_data(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+        first_response = client.get("/tiles/10/550/335.mvt")
+        db.add(SchoolFactory(id="BE-4", location='SRID=4326;POINT(13.42 52.52)'))
+        db.commit()
+
+        # Act
+        second_response = client.get("/tiles/10/550/335.mvt")
+
+        # Assert
+        assert b"BE-4" not in first_response.content
+        assert b"BE-4" in second_response.content
+
+    @pytest.mark.parametrize("tile", ["1/2/0", "1/0/2", "23/0/0"])
+    def test_validates_tile_coordinates(self, client, db, tile):
+        # Act
+        response = client.get(f"/tiles/{tile}.mvt")
+
+        # Assert
+        assert response.status_code == 400
+
+
+class TestAsyncSession:
+    @pytest.fixture
+    def async_db(self):
+        async_engine = create_async_engine(async_url(os.environ.get("DATABASE_URL_TEST")), poolclass=NullPool)
+        async_session_local = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+        async def override_get_async_db():
+            async with async_session_local() as session:
+                yield session
+
+        app.dependency_overrides[get_db] = override_get_async_db
+        yield
+        app.dependency_overrides[get_db] = override_get_db
+
+    def test_schools(self, client, db, async_db):
+        # Arrange
+        for school in [
+            SchoolFactory(id="BE-1", location='SRID=4326;POINT(13.00 52.00)', update_timestamp=datetime(2024, 1, 1)),
+            SchoolFactory(id="BE-2", update_timestamp=datetime(2022, 1, 1)),
+            SchoolFactory(id="NI-1", update_timestamp=datetime(2024, 1, 1)),
+        ]:
+            db.add(school)
+        db.commit()
+
+        # Act
+        response = client.get("/schools?state=BE&update_timestamp=2023-01-01")
+
+        # Assert
+        assert response.status_code == 200
+        assert [school["id"] for school in response.json()] == ["BE-1"]
+        assert response.json()[0]["latitude"] == 52.0
+
+    def test_school(self, client, db, async_db):
+        # Arrange
+        db.add(get_full_school())
+        db.commit()
+
+        # Act
+        response = client.get("/schools/NW-112586?include_raw=true")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.json()["raw"]["Schulnummer"] == "112586"
+
+    def test_stats_and_filter_params(self, client, db, async_db):
+        # Arrange
+        db.add(SchoolFactory(id="BE-1", school_type="Grundschule", legal_status="Privat",
+                             update_timestamp=datetime(2024, 1, 1)))
+        db.commit()
+
+        # Act
+        stats_response = client.get("/stats")
+        params_response = client.get("/filter_params")
+
+        # Assert
+        assert stats_response.json() == [{"state": "BE", "count": 1, "last_updated": "2024-01-01"}]
+        assert params_response.json() == {"state": ["BE"], "school_type": ["Grundschule"], "legal_status": ["Privat"]}
+
+
+class TestNameSearch:
+    def __search(self, client, db, names, term):
+        for i, name in enumerate(names):
+            db.add(SchoolFactory(id=f"BE-{i}", name=name))
+        db.commit()
+        response = client.get(f"/schools?name={term}")
+        assert response.status_code == 200
+        return [school["name"] for school in response.json()]
+
+    def test_ignores_spelling_of_umlauts(self, client, db):
+        # Act
+        names = self.__search(client, db, ["Schule an der Dorfstraße", "Grundschule am Deich"], "dorfstrasse")
+
+        # Assert
+        assert names == ["Schule an der Dorfstraße"]
+
+    def test_tolerates_typos(self, client, db):
+        # Act
+        names = self.__search(client, db, ["Gymnasium am Park", "Grundschule am Deich"], "Gymnasim")
+
+        # Assert
+        assert names == ["Gymnasium am Park"]
+
+    def test_ranks_by_similarity(self, client, db):
+        # Act
+        names = self.__search(client, db, ["Deichschule", "Schule am Deich", "Gymnasium am Park"], "deich")
+
+        # Assert
+        assert names == ["Schule am Deich", "Deichschule"]
+
+    def test_explicit_order_disables_ranking(self, client, db):
+        # Arrange
+        for school in [SchoolFactory(id="BE-1", name="Deichschule"),
+                       SchoolFactory(id="BE-2", name="Schule am Deich")]:
+            db.add(school)
+        db.commit()
+
+        # Act
+        response = client.get("/schools?name=deich&order_by=id&limit=1")
+
+        # Assert
+        assert [school["id"] for school in response.json()] == ["BE-1"]
+        assert "X-Next-Cursor" in response.headers
+
+    def test_creates_index_once(self, db):
+        # Act
+        models.create_indexes(engine)
+        models.create_indexes(engine)
+
+        # Assert
+        with engine.connect() as connection:
+            indexes = connection.execute(text("select indexname from pg_indexes where tablename = 'schools'")).scalars()
+            assert "ix_schools_name_trgm" in set(indexes)
+
+
+class TestFields:
+    def __setup_schools(self, db):
+        db.add(get_full_school())
+        db.add(SchoolFactory(id="NW-1", name="Schule 1", location='SRID=4326;POINT(13.00 52.00)'))
+        db.commit()
+
+    def test_returns_requested_fields(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/schools?state=NW&fields=latitude,longitude")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.json() == [
+            {"id": "NW-1", "name": "Schule 1", "latitude": 52.0, "longitude": 13.0},
+            {"id": "NW-112586", "name": "Städt. Gem. Grundschule - Primarstufe -"},
+        ]
+
+    def test_returns_raw_if_requested_as_field(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/schools/NW-112586?fields=raw,city")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.json().keys() == {"id", "name", "city", "raw"}
+
+    def test_includes_sort_key_for_cursor(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        response = client.get("/schools?fields=city&order_by=update_timestamp&limit=1")
+        next_response = client.get(f"/schools?fields=city&limit=1&cursor={response.headers['X-Next-Cursor']}")
+
+        # Assert
+        assert [school["id"] for school in response.json() + next_response.json()] == ["NW-1", "NW-112586"]
+
+    def test_rejects_unknown_fields(self, client, db):
+        # Act
+        response = client.get("/schools?fields=name,password")
+
+        # Assert
+        assert response.status_code == 400
+
+
+class TestPostgresRenderer:
+    def __setup_schools(self, db):
+        full_school = get_full_school()
+        full_school.location = 'SRID=4326;POINT(6.897017373118707 50.94217152830834)'
+        full_school.update_timestamp = datetime(2024, 1, 1, 12, 30, 5, 123)
+        for school in [
+            full_school,
+            SchoolFactory(id="BE-1", name='Schule "am" Deich\n\t\\ \x1f ẞ', location='SRID=4326;POINT(13.00 52.00)',
+                          update_timestamp=datetime(2024, 1, 1)),
+            SchoolFactory(id="BE-2", name="Schule", address=None, location='SRID=4326;POINT(13.123 -52.5)',
+                          update_timestamp=datetime(2023, 5, 6, 7, 8, 9, 500000)),
+            SchoolFactory(id="BE-3", name="Schule", location=None, update_timestamp=None),
+        ]:
+            db.add(school)
+        db.commit()
+
+    queries = [
+        "",
+        "?state=BE&limit=2",
+        "?by_lat=52.5&by_lon=13.4",
+        "?fields=latitude,update_timestamp",
+        "?name=schule",
+        "?order_by=update_timestamp&limit=3",
+        "?bb_top=53&bb_bottom=50&bb_left=5&bb_right=14",
+    ]
+    @pytest.mark.parametrize("query_params", queries)
+    def test_renders_same_bytes(self, client, db, monkeypatch, query_params):
+        # Arrange
+        self.__setup_schools(db)
+        python_response = client.get(f"/schools{query_params}")
+        monkeypatch.setattr(render, "ENGINE", "postgres")
+        # Otherwise the second request would be answered with the first body
+        response_cache.clear()
+
+        # Act
+        postgres_response = client.get(f"/schools{query_params}")
+
+        # Assert
+        assert postgres_response.status_code == 200
+        assert postgres_response.content == python_response.content
+        assert postgres_response.headers.get("X-Next-Cursor") == python_response.headers.get("X-Next-Cursor")
+
+    def test_renders_empty_list(self, client, db, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(render, "ENGINE", "postgres")
+
+        # Act
+        response = client.get("/schools")
+
+        # Assert
+        assert response.content == b"[]"
+
+
+class TestConditionalRequests:
+    def __setup_schools(self, db):
+        for school in [SchoolFactory(id="BE-1", update_timestamp=datetime(2024, 1, 1)),
+                       SchoolFactory(id="BE-2", update_timestamp=datetime(2024, 2, 1)),
+                       SchoolFactory(id="NI-1", update_timestamp=datetime(2024, 3, 1))]:
+            db.add(school)
+        db.commit()
+
+    @pytest.mark.parametrize("url", ["/schools/BE-1", "/schools?state=BE", "/stats", "/filter_params",
+                                     "/tiles/0/0/0.mvt"])
+    def test_if_none_match(self, client, db, url):
+        # Arrange
+        self.__setup_schools(db)
+        response = client.get(url)
+
+        # Act
+        conditional_response = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+
+        # Assert
+        assert response.status_code == 200
+        assert conditional_response.status_code == 304
+        assert conditional_response.content == b""
+        assert conditional_response.headers["ETag"] == response.headers["ETag"]
+
+    def test_if_modified_since(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+        response = client.get("/schools?state=BE")
+
+        # Act
+        conditional_response = client.get("/schools?state=BE",
+                                          headers={"If-Modified-Since": response.headers["Last-Modified"]})
+        older_response = client.get("/schools?state=BE",
+                                    headers={"If-Modified-Since": "Mon, 15 Jan 2024 00:00:00 GMT"})
+
+        # Assert
+        # The validators of lists cover the whole table
+        assert response.headers["Last-Modified"] == "Fri, 01 Mar 2024 00:00:00 GMT"
+        assert conditional_response.status_code == 304
+        assert older_response.status_code == 200
+
+    def test_school_without_validators_is_read_once(self, client, db, monkeypatch):
+        # Arrange
+        self.__setup_schools(db)
+        probes = []
+        monkeypatch.setattr(crud, "get_school_version", lambda *args, **kwargs: probes.append(kwargs))
+        sparse = client.get("/schools/BE-1?fields=id,name")
+
+        # Act
+        response = client.get("/schools/BE-1?fields=id,name,update_timestamp")
+
+        # Assert
+        assert probes == []
+        assert "update_timestamp" not in sparse.json()
+        assert sparse.headers["Last-Modified"] == "Mon, 01 Jan 2024 00:00:00 GMT"
+        assert response.json()["update_timestamp"].startswith("2024-01-01")
+
+    def test_changes_invalidate_etag(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+        response = client.get("/schools/BE-1")
+        school = db.get(School, "BE-1")
+        school.update_timestamp = datetime(2024, 6, 1)
+        db.commit()
+
+        # Act
+        conditional_response = client.get("/schools/BE-1", headers={"If-None-Match": response.headers["ETag"]})
+
+        # Assert
+        assert conditional_response.status_code == 200
+
+    def test_etag_depends_on_filters(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        be_response = client.get("/schools?state=BE")
+        ni_response = client.get("/schools?state=NI")
+
+        # Assert
+        assert be_response.headers["ETag"] != ni_response.headers["ETag"]
+
+    def test_etag_ignores_order_of_parameters(self, client, db):
+        # Arrange
+        self.__setup_schools(db)
+
+        # Act
+        first_response = client.get("/schools?state=BE&state=NI&limit=5")
+        second_response = client.get("/schools?limit=5&state=NI&state=BE")
+
+        # Assert
+        assert first_response.headers["ETag"] == second_response.headers["ETag"]
+
+
+class TestBatch:
+    def test_returns_schools_in_input_order(self, client, db):
+        # Arrange
+        for school in [SchoolFactory(id=f"BE-{i}", name=f"Schule {i}") for i in range(5)]:
+            db.add(school)
+        db.commit()
+
+        # Act
+        response = client.post("/schools/batch", json={"ids": ["BE-3", "XX-1", "BE-1", "BE-3"],
+                                                       "fields": ["city"]})
+
+        # Assert
+        assert response.status_code == 200
+        assert response.json() == {
+            "schools": [{"id": "BE-3", "name": "Schule 3"}, {"id": "BE-1", "name": "Schule 1"}],
+            "not_found": ["XX-1"],
+        }
+
+    def test_includes_raw_on_request(self, client, db):
+        # Arrange
+        db.add(get_full_school())
+        db.commit()
+
+        # Act
+        response = client.post("/schools/batch", json={"ids": ["NW-112586"], "include_raw": True})
+
+        # Assert
+        assert response.json()["schools"][0]["raw"]["Schulnummer"] == "112586"
+
+    def test_limits_number_of_ids(self, client, db):
+        # Act
+        response = client.post("/schools/batch", json={"ids": [f"BE-{i}" for i in range(5001)]})
+
+        # Assert
+        assert response.status_code == 422
+
+    def test_rejects_unknown_fields(self, client, db):
+        # Act
+        response = client.post("/schools/batch", json={"ids": ["BE-1"], "fields": ["password"]})
+
+        # Assert
+        assert response.status_code == 400
+
+
+class TestTotalCount:
+    def test_no_count_by_default(self, client, db):
+        # Arrange
+        db.add(SchoolFactory())
+        db.commit()
+
+        # Act
+        response = client.get("/schools/")
+
+        # Assert
+        assert "X-Total-Count" not in response.headers
+
+    def test_exact_count(self, client, db):
+        # Arrange
+        for i in range(3):
+            db.add(SchoolFactory(id=f"BE-{i}"))
+        db.add(SchoolFactory(id="HH-1"))
+        db.commit()
+
+        # Act
+        response = client.get("/schools/?state=BE&limit=1&count=exact")
+
+        # Assert
+        assert len(response.json()) == 1
+        assert response.headers["X-Total-Count"] == "3"
+
+    def test_exact_count_without_filters(self, client, db):
+        # Arrange
+        for i in range(3):
+            db.add(SchoolFactory(id=f"BE-{i}"))
+        db.commit()
+
+        # Act
+        response = client.get("/schools/?limit=1&count=exact")
+
+        # Assert
+        assert response.headers["X-Total-Count"] == "3"
+
+    def test_estimated_count_uses_stats_per_state(self, client, db):
+        # Arrange
+        for i in range(3):
+            db.add(SchoolFactory(id=f"BE-{i}"))
+        db.add(SchoolFactory(id="HH-1"))
+        db.commit()
+        client.get("/stats")
+
+        # Act
+        response = client.get("/schools/?state=BE&state=HH&limit=1&count=estimated")
+
+        # Assert
+        assert response.headers["X-Total-Count"] == "4"
+
+    def test_estimated_count_uses_outdated_stats(self, client, db):
+        # Arrange
+        for i in range(3):
+            db.add(SchoolFactory(id=f"BE-{i}"))
+        db.commit()
+        client.get("/stats")
+        db.add(SchoolFactory(id="BE-3"))
+        db.commit()
+
+        # Act
+        response = client.get("/schools/?state=BE&limit=1&count=estimated")
+
+        # Assert
+        assert response.headers["X-Total-Count"] == "3"
+
+    def test_estimated_count_for_other_filters(self, client, db):
+        # Arrange
+        for i in range(3):
+            db.add(SchoolFactory(id=f"BE-{i}", school_type="Gymnasium"))
+        db.commit()
+
+        # Act
+        response = client.get("/schools/?school_type=Gymnasium&count=estimated")
+
+        # Assert
+        assert response.status_code == 200
+        assert int(response.headers["X-Total-Count"]) >= 0
+
+
+class TestMetrics:
+    def test_exports_request_metrics_per_route(self, client, db):
+        # Arrange
+        db.add(SchoolFactory())
+        db.commit()
+        client.get("/schools/")
+
+        # Act
+        response = client.get("/metrics")
+
+        # Assert
+        assert response.status_code == 200
+        assert 'jedeschule_request_duration_seconds_count{method="GET",route="read_schools",status="200"}' \
+               in response.text
+        assert 'jedeschule_response_size_bytes_count{route="read_schools",stage="app"}' in response.text
+        assert 'jedeschule_response_size_bytes_count{route="read_schools",stage="sent"}' in response.text
+
+    def test_exports_sql_metrics(self, client, db):
+        # Arrange
+        engine = create_engine(os.environ.get("DATABASE_URL_TEST"), poolclass=metrics.InstrumentedQueuePool,
+                               pool_logging_name="test")
+        metrics.instrument_engine(engine, "test")
+        with engine.connect() as connection:
+            connection.execute(text("select 1"))
+        engine.dispose()
+
+        # Act
+        response = client.get("/metrics")
+
+        # Assert
+        assert 'jedeschule_sql_duration_seconds_count{engine="test",statement="select"}' in response.text
+        assert 'jedeschule_pool_checkout_wait_seconds_count{engine="test"}' in response.text
+        assert 'jedeschule_pool_size{engine="test"}' in response.text
+
+
+@pytest.mark.skipif("BENCHMARK_DATABASE_URL" not in os.environ,
+                    reason="Needs a database filled by `python -m benchmark.dataset`")
+class TestQueryPlans:
+    def test_filter_combinations_within_budget(self):
+        # Arrange
+        benchmark_engine = create_engine(os.environ["BENCHMARK_DATABASE_URL"])
+
+        # Act
+        with Session(benchmark_engine) as db:
+            failures, _ = plans.check(db, plans.load_budgets())
+
+        # Assert
+        assert failures == []
+
+
+class TestSnapshot:
+    @pytest.fixture
+    def schools(self, db):
+        db.add(get_full_school())
+        for i, (school_type, timestamp, location) in enumerate([
+            ("Grundschule", datetime(2023, 1, 1), "POINT(13.40 52.52)"),
+            ("Gymnasium", datetime(2024, 3, 1, 12, 30, 0, 5), "POINT(13.38 52.50)"),
+            ("Grundschule", None, None),
+            ("Gymnasium", datetime(2024, 3, 1, 12, 30, 0, 5), "POINT(9.99 53.55)"),
+        ]):
+            db.add(SchoolFactory(id=f"{'BE' if i < 3 else 'HH'}-{i}", school_type=school_type,
+                                 update_timestamp=timestamp, location=location))
+        db.commit()
+
+    @pytest.mark.parametrize("query", [
+        "",
+        "?state=BE&state=NW",
+        "?school_type=Gymnasium",
+        "?update_timestamp=2024-01-01",
+        "?bb_top=53&bb_bottom=52&bb_left=13&bb_right=14",
+        "?order_by=update_timestamp&limit=2",
+        "?skip=1&limit=2&fields=latitude,longitude",
+        "?name=grundschule",
+        "?by_lat=52.5&by_lon=13.4",
+    ])
+    def test_matches_database(self, client, db, schools, monkeypatch, query):
+        # Arrange
+        from_database = client.get(f"/schools/{query}")
+        monkeypatch.setattr(snapshot, "_current", snapshot.Snapshot.load(db))
+        # Otherwise the second request would be answered with the first body
+        response_cache.clear()
+
+        # Act
+        from_snapshot = client.get(f"/schools/{query}")
+
+        # Assert
+        assert from_snapshot.status_code == 200
+        assert from_snapshot.content == from_database.content
+        assert from_snapshot.headers["ETag"] == from_database.headers["ETag"]
+        assert from_snapshot.headers.get("X-Next-Cursor") == from_database.headers.get("X-Next-Cursor")
+
+    def test_follows_cursor(self, client, db, schools, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(snapshot, "_current", snapshot.Snapshot.load(db))
+        first_page = client.get("/schools/?order_by=update_timestamp&limit=2")
+
+        # Act
+        response = client.get(f"/schools/?limit=2&cursor={first_page.headers['X-Next-Cursor']}")
+
+        # Assert
+        assert [school["id"] for school in first_page.json() + response.json()] == ["BE-0", "BE-1", "HH-3", "BE-2"]
+
+    def test_selects_only_on_cache_miss(self, client, db, schools, monkeypatch):
+        # Arrange
+        current = snapshot.Snapshot.load(db)
+        selections = []
+        select = current.select
+
+        def counting_select(*args, **kwargs):
+            selections.append(kwargs)
+            return select(*args, **kwargs)
+
+        monkeypatch.setattr(current, "select", counting_select)
+        monkeypatch.setattr(snapshot, "_current", current)
+
+        # Act
+        first = client.get("/schools/?state=BE")
+        second = client.get("/schools/?state=BE")
+
+        # Assert
+        assert first.content == second.content
+        assert len(selections) == 1
+
+    def test_refresh_reloads_changed_data(self, client, db, schools, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(snapshot, "_current", None)
+        snapshot.refresh(TestingSessionLocal)
+        db.add(SchoolFactory(id="SN-1"))
+        db.commit()
+
+        # Act
+        snapshot.refresh(TestingSessionLocal)
+
+        # Assert
+        assert "SN-1" in snapshot.current().positions
+
+
+class TestClusters:
+    @pytest.fixture
+    def schools(self, db):
+        for i, location in enumerate(["POINT(13.40 52.52)", "POINT(13.41 52.51)", "POINT(9.99 53.55)", None]):
+            db.add(SchoolFactory(id=f"{'BE' if i < 2 else 'HH'}-{i}", location=location))
+        db.commit()
+
+    def test_groups_schools_per_cell(self, client, db, schools):
+        # Act
+        response = client.get("/schools/clusters?zoom=5")
+
+        # Assert
+        assert response.status_code == 200
+        clusters = sorted(response.json(), key=lambda cluster: cluster["count"])
+        assert [cluster["count"] for cluster in clusters] == [1, 2]
+        assert clusters[0]["id"] == "HH-2"
+        assert "id" not in clusters[1]
+        assert clusters[1]["latitude"] == pytest.approx(52.515)
+        assert clusters[1]["longitude"] == pytest.approx(13.405)
+
+    def test_separates_schools_at_high_zoom(self, client, db, schools):
+        # Act
+        response = client.get("/schools/clusters?zoom=16")
+
+        # Assert
+        assert sorted(cluster["id"] for cluster in response.json()) == ["BE-0", "BE-1", "HH-2"]
+
+    def test_filters(self, client, db, schools):
+        # Act
+        by_state = client.get("/schools/clusters?zoom=16&state=HH")
+        by_bounding_box = client.get("/schools/clusters?zoom=5&bb_top=53&bb_bottom=52&bb_left=13&bb_right=14")
+
+        # Assert
+        assert [cluster["id"] for cluster in by_state.json()] == ["HH-2"]
+        assert [cluster["count"] for cluster in by_bounding_box.json()] == [2]
+
+    def test_counts_whole_cells_touched_by_bounding_box(self, client, db, schools):
+        # Act
+        response = client.get("/schools/clusters?zoom=5&bb_top=52.53&bb_bottom=52.519&bb_left=13.39&bb_right=13.402")
+
+        # Assert
+        assert [cluster["count"] for cluster in response.json()] == [2]
+
+    def test_requires_zoom(self, client, db):
+        # Act
+        response = client.get("/schools/clusters")
+
+        # Assert
+        assert response.status_code == 422
+
+
+class TestFacets:
+    @pytest.fixture
+    def schools(self, db):
+        for i, (school_type, legal_status) in enumerate([
+            ("Grundschule", "öffentlich"),
+            ("Grundschule", "privat"),
+            ("Gymnasium", "öffentlich"),
+            (None, "öffentlich"),
+        ]):
+            db.add(SchoolFactory(id=f"{'BE' if i < 3 else 'HH'}-{i}", school_type=school_type,
+                                 legal_status=legal_status, update_timestamp=datetime(2024, 1, i + 1)))
+        db.commit()
+
+    def test_counts_all_schools(self, client, db, schools):
+        # Act
+        response = client.get("/schools/facets")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.json() == {
+            "state": [{"value": "BE", "count": 3}, {"value": "HH", "count": 1}],
+            "school_type": [{"value": "Grundschule", "count": 2}, {"value": "Gymnasium", "count": 1}],
+            "legal_status": [{"value": "öffentlich", "count": 3}, {"value": "privat", "count": 1}],
+        }
+
+    def test_facets_ignore_their_own_filter(self, client, db, schools):
+        # Act
+        response = client.get("/schools/facets?state=BE&school_type=Grundschule")
+
+        # Assert
+        assert response.json() == {
+            "state": [{"value": "BE", "count": 2}],
+            "school_type": [{"value": "Grundschule", "count": 2}, {"value": "Gymnasium", "count": 1}],
+            "legal_status": [{"value": "privat", "count": 1}, {"value": "öffentlich", "count": 1}],
+        }
+
+    def test_other_filters_apply_to_all_facets(self, client, db, schools):
+        # Act
+        response = client.get("/schools/facets?update_timestamp=2024-01-02")
+
+        # Assert
+        assert response.json() == {
+            "state": [{"value": "BE", "count": 1}, {"value": "HH", "count": 1}],
+            "school_type": [{"value": "Gymnasium", "count": 1}],
+            "legal_status": [{"value": "öffentlich", "count": 2}],
+        }
+
+
+class TestChanges:
+    @pytest.fixture
+    def schools(self, db):
+        for i, timestamp in enumerate([datetime(2024, 1, 2), datetime(2024, 1, 1), datetime(2024, 1, 2)]):
+            db.add(SchoolFactory(id=f"BE-{i}", update_timestamp=timestamp))
+        db.commit()
+
+    def test_lists_schools_by_update_timestamp_and_id(self, client, db, schools):
+        # Act
+        response = client.get("/schools/changes")
+
+        # Assert
+        assert response.status_code == 200
+        changes = response.json()["changes"]
+        assert [(change["op"], change["id"]) for change in changes] == \
+               [("upsert", "BE-1"), ("upsert", "BE-0"), ("upsert", "BE-2")]
+        assert changes[0]["school"]["name"] == db.get(School, "BE-1").name
+        assert response.json()["has_more"] is False
+
+    def test_pages_with_checkpoint(self, client, db, schools):
+        # Arrange
+        first_page = client.get("/schools/changes?limit=2").json()
+
+        # Act
+        second_page = client.get(f"/schools/changes?limit=2&checkpoint={first_page['checkpoint']}").json()
+        third_page = client.get(f"/schools/changes?limit=2&checkpoint={second_page['checkpoint']}").json()
+
+        # Assert
+        assert first_page["has_more"] is True
+        assert [change["id"] for change in second_page["changes"]] == ["BE-2"]
+        assert third_page["changes"] == []
+        assert third_page["checkpoint"] == second_page["checkpoint"]
+
+    def test_reports_updates_and_removals(self, client, db, schools):
+        # Arrange
+        checkpoint = client.get("/schools/changes").json()["checkpoint"]
+        db.get(School, "BE-1").update_timestamp = datetime(2024, 2, 1)
+        db.delete(db.get(School, "BE-2"))
+        db.commit()
+
+        # Act
+        response = client.get(f"/schools/changes?checkpoint={checkpoint}")
+
+        # Assert
+        changes = response.json()["changes"]
+        assert [(change["op"], change["id"]) for change in changes] == [("upsert", "BE-1"), ("delete", "BE-2")]
+        assert "school" not in changes[1]
+
+    def test_reports_new_schools_with_old_timestamps(self, client, db, schools):
+        # Arrange
+        checkpoint = client.get("/schools/changes").json()["checkpoint"]
+        db.add(SchoolFactory(id="BE-3", update_timestamp=datetime(2020, 1, 1)))
+        db.add(SchoolFactory(id="BE-4", update_timestamp=None))
+        db.commit()
+
+        # Act
+        response = client.get(f"/schools/changes?checkpoint={checkpoint}")
+
+        # Assert
+        assert [change["id"] for change in response.json()["changes"]] == ["BE-3", "BE-4"]
+
+    def test_reports_updates_which_keep_the_data_version(self, client, db, schools):
+        # Arrange
+        checkpoint = client.get("/schools/changes").json()["checkpoint"]
+        db.get(School, "BE-1").update_timestamp = datetime(2024, 1, 2)
+        db.commit()
+
+        # Act
+        response = client.get(f"/schools/changes?checkpoint={checkpoint}")
+
+        # Assert
+        assert [change["id"] for change in response.json()["changes"]] == ["BE-1"]
+
+    def test_rejects_invalid_checkpoint(self, client, db):
+        # Act
+        response = client.get("/schools/changes?checkpoint=nonsense")
+
+        # Assert
+        assert response.status_code == 400
+
+
+class TestDownloads:
+    @pytest.fixture
+    def built(self, db, tmp_path, monkeypatch):
+        for i in range(3):
+            db.add(SchoolFactory(id=f"BE-{i}", update_timestamp=datetime(2024, 1, 1)))
+        db.add(SchoolFactory(id="HH-0", update_timestamp=datetime(2024, 1, 2)))
+        db.commit()
+        monkeypatch.setattr(downloads, "DOWNLOADS_DIR", str(tmp_path))
+        monkeypatch.setattr(downloads, "_current", None)
+        downloads.refresh(TestingSessionLocal)
+
+    def test_lists_files(self, client, db, built):
+        # Act
+        response = client.get("/downloads")
+
+        # Assert
+        assert response.status_code == 200
+        names = [download["name"] for download in response.json()]
+        assert "schools-DE.geojson.gz" in names
+        assert "schools-BE.parquet" in names
+        assert response.json()[0]["url"] == "http://testserver/downloads/schools-DE.geojson.gz"
+
+    def test_sends_geojson_gzip_encoded(self, client, db, built):
+        # Act
+        response = client.get("/downloads/schools-BE.geojson.gz")
+
+        # Assert
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Content-Type"] == "application/geo+json"
+        assert sorted(feature["properties"]["id"] for feature in response.json()["features"]) == \
+               ["BE-0", "BE-1", "BE-2"]
+
+    def test_sends_ranges_and_validators(self, client, db, built):
+        # Arrange
+        etag = client.get("/downloads/schools-DE.parquet").headers["ETag"]
+
+        # Act
+        partial = client.get("/downloads/schools-DE.parquet", headers={"Range": "bytes=0-3"})
+        not_modified = client.get("/downloads/schools-DE.parquet", headers={"If-None-Match": etag})
+
+        # Assert
+        assert partial.status_code == 206
+        assert partial.content == b"PAR1"
+        assert not_modified.status_code == 304
+
+    def test_rebuilds_after_changes(self, client, db, built):
+        # Arrange
+        etag = client.get("/downloads/schools-HH.geojson.gz").headers["ETag"]
+        db.add(SchoolFactory(id="HH-1", update_timestamp=datetime(2024, 2, 1)))
+        db.commit()
+
+        # Act
+        downloads.refresh(TestingSessionLocal)
+        response = client.get("/downloads/schools-HH.geojson.gz")
+
+        # Assert
+        assert response.headers["ETag"] != etag
+        assert len(response.json()["features"]) == 2
+
+    def test_unknown_file(self, client, db, built):
+        # Act
+        response = client.get("/downloads/schools-XX.parquet")
+
+        # Assert
+        assert response.status_code == 404
+
+
+class TestResponseCache:
+    @pytest.fixture
+    def schools(self, db):
+        for i in range(20):
+            db.add(SchoolFactory(id=f"BE-{i}", update_timestamp=datetime(2024, 1, 1)))
+        db.commit()
+
+    def test_serves_equal_queries_from_cache(self, client, db, schools):
+        # Arrange
+        first = client.get("/schools/?state=BE&school_type=Gymnasium&school_type=Grundschule",
+                           headers={"Accept-Encoding": "gzip"})
+        hits = response_cache.hits
+
+        # Act
+        second = client.get("/schools/?school_type=Grundschule&school_type=Gymnasium&state=BE",
+                            headers={"Accept-Encoding": "gzip"})
+
+        # Assert
+        assert response_cache.hits == hits + 1
+        assert second.content == first.content
+
+    def test_compresses_for_accepted_encoding(self, client, db, schools):
+        # Act
+        compressed = client.get("/schools/", headers={"Accept-Encoding": "gzip"})
+        uncompressed = client.get("/schools/", headers={"Accept-Encoding": "identity"})
+
+        # Assert
+        assert compressed.headers["Content-Encoding"] == "gzip"
+        assert "Content-Encoding" not in uncompressed.headers
+        assert compressed.headers["Vary"] == "Accept-Encoding"
+        assert compressed.json() == uncompressed.json()
+
+    def test_compresses_outside_of_event_loop(self, client, db, schools, monkeypatch):
+        # Arrange
+        compress = compression.compress
+        on_event_loop = []
+
+        def recording_compress(body, coding):
+            try:
+                asyncio.get_running_loop()
+                on_event_loop.append(True)
+            except RuntimeError:
+                on_event_loop.append(False)
+            return compress(body, coding)
+
+        monkeypatch.setattr(compression, "compress", recording_compress)
+
+        # Act
+        response = client.get("/schools/", headers={"Accept-Encoding": "gzip"})
+
+        # Assert
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert on_event_loop == [False]
+
+    def test_misses_after_data_changed(self, client, db, schools):
+        # Arrange
+        client.get("/schools/")
+        db.add(SchoolFactory(id="BE-99", update_timestamp=datetime(2024, 2, 1)))
+        db.commit()
+        misses = response_cache.misses
+
+        # Act
+        response = client.get("/schools/")
+
+        # Assert
+        assert response_cache.misses == misses + 1
+        assert "BE-99" in [school["id"] for school in response.json()]
+
+    @pytest.mark.parametrize("accept_encoding, expected", [
+        (None, None),
+        ("gzip, deflate", "gzip"),
+        ("gzip;q=0", None),
+        ("*", next(iter(compression.COMPRESSORS))),
+        ("identity", None),
+    ])
+    def test_negotiates_encoding(self, accept_encoding, expected):
+        # Act
+        coding = compression.negotiate(accept_encoding)
+
+        # Assert
+        assert coding == expected
+
+
+class TestReplicas:
+    @pytest.fixture
+    def replica_set(self):
+        replica_set = [replicas.Replica(f"replica{i}", Engines(engine, TestingSessionLocal, None, None))
+                       for i in range(3)]
+        for replica in replica_set:
+            replica.healthy = True
+        return replica_set
+
+    def test_round_robin(self, replica_set):
+        # Arrange
+        router = replicas.ReadRouter(replica_set, "round_robin")
+        replica_set[1].healthy = False
+
+        # Act
+        chosen = [router.choose().name for _ in range(4)]
+
+        # Assert
+        assert chosen == ["replica0", "replica2", "replica0", "replica2"]
+
+    def test_least_connections(self, replica_set, monkeypatch):
+        # Arrange
+        router = replicas.ReadRouter(replica_set, "least_connections")
+        connections = {"replica0": 4, "replica1": 1, "replica2": 2}
+        monkeypatch.setattr(replicas.Replica, "checked_out", lambda replica: connections[replica.name])
+
+        # Act
+        chosen = router.choose()
+
+        # Assert
+        assert chosen.name == "replica1"
+
+    def test_falls_back_to_primary(self, replica_set):
+        # Arrange
+        router = replicas.ReadRouter(replica_set)
+        for replica in replica_set:
+            replica.healthy = False
+
+        # Act
+        session_factory = router.sessionmaker()
+
+        # Assert
+        assert router.choose() is None
+        assert session_factory is replicas.database.SessionLocal
+
+    def test_primary_is_not_a_healthy_replica(self, db, replica_set):
+        # Act
+        replica_set[0].check()
+
+        # Assert
+        assert replica_set[0].healthy is False
+        assert replica_set[0].lag is None
+
+
+class TestSingleFlight:
+    def test_coalesces_concurrent_calls(self):
+        # Arrange
+        flight = singleflight.SingleFlight("test")
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ["BE-1"]
+
+        async def run():
+            return await asyncio.gather(*(flight.do("key", query) for _ in range(10)))
+
+        # Act
+        results = asyncio.run(run())
+
+        # Assert
+        assert len(calls) == 1
+        assert results == [["BE-1"]] * 10
+        assert len(flight) == 0
+
+    def test_shares_errors_and_runs_again(self):
+        # Arrange
+        flight = singleflight.SingleFlight("test")
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        async def run():
+            first = await asyncio.gather(*(flight.do("key", query) for _ in range(3)), return_exceptions=True)
+            second = await asyncio.gather(flight.do("key", query), return_exceptions=True)
+            return first + second
+
+        # Act
+        results = asyncio.run(run())
+
+        # Assert
+        assert len(calls) == 2
+        assert all(isinstance(result, ValueError) for result in results)
+
+    def test_waiter_takes_over_from_cancelled_leader(self):
+        # Arrange
+        flight = singleflight.SingleFlight("test")
+        calls = []
+
+        async def query():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do("key", query))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(flight.do("key", query))
+            await asyncio.sleep(0)
+            leader.cancel()
+            return await waiter
+
+        # Act
+        result = asyncio.run(run())
+
+        # Assert
+        assert result == 2
+
+
+class TestAdmission:
+    def test_rejects_limit_above_maximum(self, client, db):
+        # Act
+        response = client.get(f"/schools/?limit={admission.MAX_LIMIT + 1}")
+
+        # Assert
+        assert response.status_code == 422
+
+    def test_rejects_negative_limit_and_skip(self, client, db):
+        # Act
+        negative_limit = client.get("/schools/?limit=-1")
+        zero_limit = client.get("/schools/?limit=0")
+        negative_skip = client.get("/schools/?skip=-1")
+
+        # Assert
+        assert negative_limit.status_code == 422
+        assert zero_limit.status_code == 422
+        assert negative_skip.status_code == 422
+
+    def test_sheds_load_when_all_slots_are_taken(self, client, db, monkeypatch):
+        # Arrange
+        db.add(SchoolFactory(id="BE-1"))
+        db.commit()
+        monkeypatch.setattr(admission.QUERIES, "limit", 0)
+
+        # Act
+        listing = client.get("/schools/")
+        lookup = client.get("/schools/BE-1")
+
+        # Assert
+        assert listing.status_code == 503
+        assert listing.headers["Retry-After"] == "1"
+        assert lookup.status_code == 200
+        assert admission.LOOKUPS.active == 0
+
+    def test_leaves_connections_for_lookups_while_queries_are_full(self, db):
+        # Arrange
+        db.add(SchoolFactory(id="BE-1"))
+        db.commit()
+        busy = [database.engine.connect() for _ in range(admission.QUERIES.limit + admission.EXPORTS.limit)]
+
+        # Act
+        try:
+            with database.SessionLocal() as session:
+                school = crud.get_school(session, "BE-1")
+        finally:
+            for connection in busy:
+                connection.close()
+
+        # Assert
+        assert school is not None
+
+    def test_rejects_expensive_requests(self, client, db, monkeypatch):
+        # Arrange
+        monkeypatch.setattr(admission, "MAX_COST", 0.001)
+
+        # Act
+        response = client.get("/schools/?name=grundschule&include_raw=true&limit=10000")
+
+        # Assert
+        assert response.status_code == 400
+
+    def test_prices_only_uncached_requests(self, client, db, monkeypatch):
+        # Arrange
+        db.add(SchoolFactory(id="BE-1"))
+        db.commit()
+        priced = []
+        estimate = crud.estimate_schools_cost
+
+        def estimate_schools_cost(session, **kwargs):
+            priced.append(kwargs["count"])
+            return estimate(session, **kwargs)
+
+        monkeypatch.setattr(admission, "MAX_COST", 1e9)
+        monkeypatch.setattr(crud, "estimate_schools_cost", estimate_schools_cost)
+
+        # Act
+        first = client.get("/schools/?count=exact")
+        second = client.get("/schools/?count=exact")
+
+        # Assert
+        assert first.status_code == second.status_code == 200
+        assert priced == [True]
+
+    def test_sets_statement_timeout_per_transaction(self, db):
+        # Arrange
+        session = TestingSessionLocal()
+        session.info["statement_timeout"] = 1500
+
+        # Act
+        with_timeout = session.execute(text("SHOW statement_timeout")).scalar()
+        session.commit()
+        session.info.pop("statement_timeout")
+        without_timeout = session.execute(text("SHOW statement_timeout")).scalar()
+        session.close()
+
+        # Assert
+        assert with_timeout == "1500ms"
+        assert without_timeout == "0"
+
+    def test_answers_timeouts_with_503(self, client, db, monkeypatch):
+        # Arrange
+        def slow_version(session):
+            session.info["statement_timeout"] = 10
+            session.commit()
+            return session.execute(text("SELECT pg_sleep(1)")).scalar()
+
+        monkeypatch.setattr(crud, "get_data_version", slow_version)
+
+        # Act
+        response = client.get("/schools/")
+
+        # Assert
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+
+    def test_releases_export_slot_if_stream_never_starts(self, db):
+        # Arrange
+        response = export_schools(format=ExportFormat.ndjson, include_raw=False, filter_params={},
+                                  session_factory=TestingSessionLocal)
+        active = admission.EXPORTS.active
+
+        # Act
+        del response
+        gc.collect()
+
+        # Assert
+        assert active == 1
+        assert admission.EXPORTS.active == 0
+
+    def test_releases_export_slot_if_client_disconnects(self, db):
+        # Arrange
+        db.add(SchoolFactory(id="BE-1"))
+        db.commit()
+        response = export_schools(format=ExportFormat.ndjson, include_raw=False, filter_params={},
+                                  session_factory=TestingSessionLocal)
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                raise OSError("Connection reset by peer")
+
+        # Act
+        with pytest.raises(ClientDisconnect):
+            asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send))
+
+        # Assert
+        assert admission.EXPORTS.active == 0